@@ -1,3 +1,5 @@
+import numpy as np
+
 _sbox=(
 0x63,0x7c,0x77,0x7b,0xf2,0x6b,0x6f,0xc5,0x30,0x01,0x67,0x2b,0xfe,0xd7,0xab,0x76,
 0xca,0x82,0xc9,0x7d,0xfa,0x59,0x47,0xf0,0xad,0xd4,0xa2,0xaf,0x9c,0xa4,0x72,0xc0,
@@ -159,6 +161,64 @@ def shiftrows (state):
         state[i::4] = _shiftrow(state[i::4],i)
     return state
     
+def inv_subbytes(inp):
+    return [invsbox(i) for i in inp]
+    
+def inv_mixcolumns(state):
+    return _mixcolumns(state, True)
+    
+def inv_shiftrows (state):
+    #Same as shiftrows, but rotating each row right (left by 4-i)
+    for i in 1,2,3:
+        state[i::4] = _shiftrow(state[i::4],4-i)
+    return state
+    
+    
+# Batch versions of the round functions: each takes an (N x 16) uint8 array 
+# with one state per row, and uses table lookups and fancy indexing instead of
+# Python loops
+_sbox_array = np.array(_sbox, dtype=np.uint8)
+_invsbox_array = np.argsort(_sbox_array).astype(np.uint8)
+_gal2_array = np.array(_gal2, dtype=np.uint8)
+_gal3_array = np.array(_gal3, dtype=np.uint8)
+_galI_arrays = [np.array(g, dtype=np.uint8) for g in _galI]
+
+# State byte i is row i%4, column i/4; row r is rotated left by r columns
+_shiftrows_index = np.array([i%4 + 4*((i/4 + i%4) % 4) for i in range(16)])
+_inv_shiftrows_index = np.argsort(_shiftrows_index)
+
+def subbytes_batch(state):
+    return _sbox_array[state]
+
+def shiftrows_batch(state):
+    return state[:, _shiftrows_index]
+
+def mixcolumns_batch(state):
+    s = state.reshape(-1, 4, 4)
+    a0, a1, a2, a3 = s[:, :, 0], s[:, :, 1], s[:, :, 2], s[:, :, 3]
+    out = np.empty_like(s)
+    out[:, :, 0] = _gal2_array[a0] ^ _gal3_array[a1] ^ a2 ^ a3
+    out[:, :, 1] = a0 ^ _gal2_array[a1] ^ _gal3_array[a2] ^ a3
+    out[:, :, 2] = a0 ^ a1 ^ _gal2_array[a2] ^ _gal3_array[a3]
+    out[:, :, 3] = _gal3_array[a0] ^ a1 ^ a2 ^ _gal2_array[a3]
+    return out.reshape(-1, 16)
+    
+def inv_subbytes_batch(state):
+    return _invsbox_array[state]
+    
+def inv_shiftrows_batch(state):
+    return state[:, _inv_shiftrows_index]
+    
+def inv_mixcolumns_batch(state):
+    g0, g1, g2, g3 = _galI_arrays
+    s = state.reshape(-1, 4, 4)
+    a0, a1, a2, a3 = s[:, :, 0], s[:, :, 1], s[:, :, 2], s[:, :, 3]
+    out = np.empty_like(s)
+    out[:, :, 0] = g0[a0] ^ g1[a1] ^ g2[a2] ^ g3[a3]
+    out[:, :, 1] = g3[a0] ^ g0[a1] ^ g1[a2] ^ g2[a3]
+    out[:, :, 2] = g2[a0] ^ g3[a1] ^ g0[a2] ^ g1[a3]
+    out[:, :, 3] = g1[a0] ^ g2[a1] ^ g3[a2] ^ g0[a3]
+    return out.reshape(-1, 16)
     
 def sbox(inp):
     s =  [0x63, 0x7c, 0x77, 0x7b, 0xf2, 0x6b, 0x6f, 0xc5, 0x30, 0x01, 0x67,
@@ -354,4 +414,79 @@ def keyScheduleRounds(inputkey, inputround, desiredround):
             state = state[0:16]
 
     #Return answer
-    return state
\ No newline at end of file
+    return state
+
+
+def key_expansion_batch(key, Nr):
+    """Expand many AES-128 or AES-256 keys at once.
+    
+    Arguments:
+        key (N x 16 or N x 32 array of uint8): one key per row
+        Nr (int): last round key to find (10 for AES-128, 14 for AES-256)
+        
+    Returns:
+        (Nr+1 x N x 16 array of uint8): round key r of each key in row r, 
+            the same as keyScheduleRounds(key, 0, r)
+    """
+    key = np.asarray(key, dtype=np.uint8)
+    Nk = key.shape[1] / 4
+    
+    # The key schedule as 4-byte words
+    w = np.zeros((len(key), 4*(Nr+1), 4), dtype=np.uint8)
+    w[:, :Nk] = key.reshape(-1, Nk, 4)
+    for i in range(Nk, 4*(Nr+1)):
+        temp = w[:, i-1]
+        if i % Nk == 0:
+            temp = _sbox_array[temp[:, [1, 2, 3, 0]]]
+            temp[:, 0] ^= rcon[i/Nk]
+        elif Nk > 6 and i % Nk == 4:
+            temp = _sbox_array[temp]
+        w[:, i] = w[:, i-Nk] ^ temp
+    return w.reshape(len(key), Nr+1, 16).transpose(1, 0, 2)
+
+def test_round_functions():
+    states = np.random.randint(0, 256, (50, 16)).astype(np.uint8)
+    pairs = [
+        [subbytes_batch, subbytes], [shiftrows_batch, shiftrows], [mixcolumns_batch, mixcolumns],
+        [inv_subbytes_batch, inv_subbytes], [inv_shiftrows_batch, inv_shiftrows], [inv_mixcolumns_batch, inv_mixcolumns],
+    ]
+    for [batch, single] in pairs:
+        # The per-state functions work in place on lists
+        if batch(states).tolist() != [list(single([int(b) for b in s])) for s in states]:
+            raise ValueError("%s differs from %s" % (batch.__name__, single.__name__))
+            
+    for [fwd, inv] in [[subbytes_batch, inv_subbytes_batch], [shiftrows_batch, inv_shiftrows_batch], [mixcolumns_batch, inv_mixcolumns_batch]]:
+        if not np.array_equal(inv(fwd(states)), states):
+            raise ValueError("%s doesn't undo %s" % (inv.__name__, fwd.__name__))
+            
+    print "Round Functions: [PASS]"
+    
+def test_key_expansion_batch():
+    for [nbytes, Nr] in [[16, 10], [32, 14]]:
+        keys = np.random.randint(0, 256, (20, nbytes)).astype(np.uint8)
+        ks = key_expansion_batch(keys, Nr)
+        for [i, k] in enumerate(keys):
+            for r in range(Nr+1):
+                if ks[r, i].tolist() != keyScheduleRounds([int(b) for b in k], 0, r):
+                    raise ValueError("Round key %d of a %d-byte key differs from keyScheduleRounds()" % (r, nbytes))
+                    
+    # Last round keys of FIPS-197 appendices A.1 and A.3
+    vectors = [
+        ['2b7e151628aed2a6abf7158809cf4f3c', 10, 'd014f9a8c9ee2589e13f0cc8b6630ca6'],
+        ['603deb1015ca71be2b73aef0857d77811f352c073b6108d72d9810a30914dff4', 14, 'fe4890d1e6188d0b046df344706c631e'],
+    ]
+    for [key, Nr, last] in vectors:
+        k = np.frombuffer(bytearray.fromhex(key), dtype=np.uint8)[None, :]
+        if bytearray(key_expansion_batch(k, Nr)[Nr, 0]) != bytearray.fromhex(last):
+            raise ValueError("Round key %d of %s should be %s" % (Nr, key, last))
+            
+    print "Key Expansion Batch: [PASS]"
+    
+if __name__ == "__main__":
+    tests = [
+        test_round_functions,
+        test_key_expansion_batch,
+    ]
+    
+    for t in tests:
+        t()
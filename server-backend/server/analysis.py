@@ -5,28 +5,28 @@ Multithreaded t-tests for ChipWhisperer projects
 """
 
 
-import multiprocessing as mp
-import multiprocessing.pool
 import statsmodels.api as sm
 import chipwhisperer.common.api.TraceManager as cwtm
 import models
 import os.path
 import numpy as np
 import re
+import shutil
+import tempfile
 import time
 import traceback
-import itertools
 import types
 import copy_reg
-from tqdm import tqdm
-import scipy.stats
-import warnings
+import math
+import ttest
+import intermediates
 
 #TODO: Currently all the seperate threads have try...except wrapping them. It appears this might be the best way to actually get useful debug/info out of them, since they
 #      are all in different threads. But it should have some nicer "stuff" around it
 
 # This crazy copy_reg stuff comes from https://stackoverflow.com/questions/25156768/cant-pickle-type-instancemethod-using-pythons-multiprocessing-pool-apply-a
-# It's required to use the pool.map multiprocessing step.
+# It lets bound methods be pickled, so they can be sent to the worker service
+# as jobs.
 def _pickle_method(m):
     if m.im_self is None:
         return getattr, (m.im_class, m.im_func.func_name)
@@ -37,23 +37,237 @@ copy_reg.pickle(types.MethodType, _pickle_method)
 
 import shelve_db
 from shelve_db import Project, Result
+import trace_store
+import state_store
+import cache_store
+import result_store
+import workers
+import writer
 
-def update_result(res):
-    """Find a result with this ID and update its status and data.
+# Upper bound on the memory used by the sum matrices of one batch of t-tests
+max_batch_bytes = 2**28
+
+# Upper bound on the memory used by the chunk of traces being accumulated
+max_chunk_bytes = 2**26
+
+# Number of traces in each block of the leakage cache. Blocks start at 
+# multiples of this trace index, whatever the config, so every project and 
+# every incremental analysis of the same traces finds the same blocks. The 
+# setup jobs find the states of one block at a time.
+cache_block_rows = 2**12
+
+# Highest order of univariate t-test that projects can ask for
+max_order = 4
+
+# Trace counts where t-test curves are sampled: curve_start, then a geometric 
+# series with a ratio of curve_ratio
+curve_start = 100
+curve_ratio = 2**0.5
+
+# Directory for the per-project trace blocks shared with the worker processes
+store_path = 'db'
+
+# Directory for the saved t-test sums of incremental projects
+state_path = 'db'
+
+# Directory for the cached leakage states, and the most space they can use
+cache_path = 'db'
+max_cache_bytes = 2**32
+
+# Directory for the t-traces of finished results
+result_path = 'db'
+
+# Projects with setup shards still running: pid -> [number of shards left, 
+# output of setup_thread()]
+pending_setup = {}
+
+def init(db_path):
+    global store_path, state_path, cache_path, result_path
+    store_path = os.path.join(db_path, 'traces')
+    state_path = os.path.join(db_path, 'state')
+    cache_path = os.path.join(db_path, 'cache')
+    result_path = os.path.join(db_path, 'results')
+
+def result_keys(order):
+    """Names of the t-traces saved for each result, in result buffer order.
     """
-    proj_list = shelve_db.get_projects()
-    res_list  = shelve_db.get_results()
-    res_list[res.id] = res
+    return ['trace_0', 'trace_1', 'trace_c'] + ['trace_c_%d' % d for d in range(2, order + 1)]
+
+def queue_results(record):
+    """Pass a worker's completion record on to the writer thread.
+    
+    This is the callback of every analysis job, so it has to return quickly:
+    the pool runs all callbacks on one thread.
+    """
+    if record:
+        writer.submit(update_results, record)
         
+def fail_project(pid, status):
+    """Stop a project after an error in one of its jobs.
+    
+    This is called from the pool's callback thread, so it never raises. The 
+    project is saved by the writer thread, in order with its results; see 
+    stop_project().
+    
+    Arguments:
+        pid (int): ID of the project
+        status (string): failed status to show for the project
+    """
+    pending_setup.pop(pid, None)
+    writer.submit(update_results, {'pid':pid, 'status':status})
+    
+def stop_project(proj, status):
+    """Mark a project as failed and release its trace block, group store and 
+    result buffer.
+    
+    Jobs of the project that are still queued fail when they find their 
+    files gone, and update_results() drops whatever they send back.
+    """
+    proj.running = False
+    proj.status = status
+    for fname in [trace_store.store_fname(store_path, proj.id),
+                  trace_store.group_fname(store_path, proj.id),
+                  trace_store.buffer_fname(store_path, proj.id)]:
+        try:
+            trace_store.release_traces(fname)
+        except:
+            print traceback.format_exc()
+
+def update_results(records):
+    """Save a batch of finished results and update their parent projects.
+    
+    The worker only returns where it put the t-traces in the project's result
+    buffer; they're copied from there into each result's trace file.
+    
+    This runs in the writer thread, with every completion record that came
+    in during one flush interval. All of the results are written in one 
+    transaction, and each parent project is only written once.
+    
+    An error in one project's records fails that project only; records of 
+    a project that has already failed are dropped.
+    
+    Arguments:
+        records (list of dicts): completion records returned by 
+            worker_thread(), or failure records from fail_project(), which 
+            have a status instead of results
+    """
+    proj_list = shelve_db.get_projects()
+    results   = shelve_db.get_results()
+    projs = proj_list.get_many(set(record['pid'] for record in records))
+    res_dict = results.get_many([rid for record in records for rid in record.get('rids', [])])
+    
+    # pid -> [number of results finished, completion records]
+    done = {}
+    for record in records:
+        pid = record['pid']
+        if pid not in projs:
+            print "Error in results of project %d - could not find the project" % pid
+            continue
+        proj = projs[pid]
+        if proj.status.startswith('failed'):
+            continue
+        done.setdefault(pid, [0, []])
+        if 'status' in record:
+            stop_project(proj, record['status'])
+            continue
+        try:
+            buf = trace_store.attach_traces(record['fname'])
+            keys = result_keys(buf.shape[1] - 2)
+            for i, (rid, row) in enumerate(zip(record['rids'], record['rows'])):
+                res = res_dict[rid]
+                res.trace_fname = result_store.traces_fname(result_store.result_dir(result_path, pid), rid)
+                res.trace_keys = keys
+                result_store.save_traces(res.trace_fname, buf[row])
+                res.summary = result_store.summarize(buf[row], keys)
+                res.data = {}
+                if record['curves'] is not None:
+                    res.data.update(record['curves'][i])
+                res.status = "finished"
+            del buf
+        except:
+            print traceback.format_exc()
+            stop_project(proj, "failed (error saving results)")
+            continue
+        done[pid][0] += len(record['rids'])
+        done[pid][1].append(record)
     try:
-        proj = proj_list[res.pid]
-        proj.remaining -= 1
+        results.set_many(res_dict)
+    except:
+        print traceback.format_exc()
+        for pid in done:
+            stop_project(projs[pid], "failed (error saving results)")
+        
+    for pid in done:
+        [count, pid_records] = done[pid]
+        proj = projs[pid]
+        if proj.status.startswith('failed'):
+            continue
+        proj.remaining -= count
         if proj.remaining == 0:
             proj.running = False
             proj.status = "finished"
-        proj_list[res.pid] = proj
-    except KeyError:
-        raise KeyError("Error in result %d - could not find parent project %d" % (res.id, res.pid))
+            start_archive(proj)
+            trace_store.release_traces(trace_store.store_fname(store_path, pid))
+            trace_store.release_traces(trace_store.group_fname(store_path, pid))
+            trace_store.release_traces(pid_records[0]['fname'])
+            if proj.incremental:
+                proj.numtraces = proj.next_numtraces
+                proj.fingerprint = proj.next_fingerprint
+                state_store.clean_state(state_store.state_dir(state_path, pid), proj.numtraces)
+    proj_list.set_many(dict((pid, projs[pid]) for pid in done))
+        
+def start_archive(proj):
+    """Queue a job to collect the t-traces of a finished project into its 
+    archive.
+    
+    The archive is copied by a worker, so the writer thread can go on saving
+    other projects' results. The project is marked archived once it's done; 
+    a project whose archive can't be made still finishes, and its results 
+    are all saved on their own.
+    """
+    try:
+        res_dict = shelve_db.get_results().get_many(proj.results)
+        res_list = [res_dict[rid] for rid in proj.results]
+        if not res_list or any(r.trace_fname is None for r in res_list):
+            return
+        workers.submit(archive_thread, 
+            args=(proj.id, result_store.result_dir(result_path, proj.id), 
+                  [r.name for r in res_list], [r.trace_fname for r in res_list], res_list[0].trace_keys), 
+            callback=archive_done)
+    except:
+        print traceback.format_exc()
+        
+def archive_thread(pid, dirname, names, trace_fnames, keys):
+    """Write the archive of project pid with result_store.save_archive().
+    
+    Returns:
+        dict with pid and archived, which is False if the archive failed
+    """
+    try:
+        result_store.save_archive(dirname, names, trace_fnames, keys)
+        return {'pid':pid, 'archived':True}
+    except:
+        print traceback.format_exc()
+        return {'pid':pid, 'archived':False}
+        
+def archive_done(record):
+    """Pass a finished archive job on to the writer thread.
+    """
+    if record['archived']:
+        writer.submit(mark_archived, record['pid'])
+        
+def mark_archived(pids):
+    """Mark the projects in pids as having an archive, in the writer thread.
+    
+    A project that was started again while its archive was being made is 
+    left alone; its archive belongs to the old results.
+    """
+    proj_list = shelve_db.get_projects()
+    projs = proj_list.get_many(pids)
+    for proj in projs.values():
+        if proj.status == "finished":
+            proj.archived = True
+    proj_list.set_many(projs)
         
 def load_data(proj_name):
     # Loads plaintext, key values, and traces for a project
@@ -130,88 +344,271 @@ def welch_ttest(group, traces):
     # Compute Welch's t-statistic at each point in time
     # Here, group[] must only contain booleans (True/False)
     try:
-        traces_true = traces[np.where(np.array(group))]
-        traces_false = traces[np.where(~np.array(group))]
-        
-        if len(traces_true) == 0:
-            traces_true  = np.array([[np.nan for _ in range(len(traces[0]))]])
-        if len(traces_false) == 0:
-            traces_false = np.array([[np.nan for _ in range(len(traces[0]))]])
-        
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            ttrace = scipy.stats.ttest_ind(traces_true, traces_false, axis=0, equal_var=False).statistic
-            
-        return np.nan_to_num(ttrace) 
+        return ttest.batch_welch_ttest([group], traces)[0]
     except Exception as e:
         print traceback.format_exc()
     
 def student_ttest(group, traces):
     try:
-        group = np.array(group)
-        S_x = np.sum(group)
-        S_y = np.sum(traces, axis=0)
-        S_xx = np.sum(group**2)
-        S_yy = np.sum(traces**2, axis=0)
-        S_xy = np.inner(np.transpose(traces), group)
-        
-        n = len(group)
-        beta = (n*S_xy - S_x*S_y) / (n*S_xx - S_x**2)
-        alpha = S_y/n - beta*S_x/n
-        s_e2 = (n*S_yy - S_y**2 - beta**2 * (n*S_xx - S_x**2)) / n / (n-2)
-        s_beta2 = n*s_e2 / (n*S_xx - S_x**2)
-        
-        t = beta / np.sqrt(s_beta2)
-        return np.nan_to_num(t) 
+        return ttest.batch_student_ttest([group], traces)[0]
     except Exception as e:
         print traceback.format_exc()
     
-def worker_thread(group, numtraces, tracelen, proj_name, res):
+def worker_thread(groups, trace_fname, out, is_welch=None, true_val=None, index=None, sign=None, state=None, order=1, curve=False, group_rows=None):
+    """Run the t-tests for a batch of groupings in one pass over the traces.
+    
+    The t-traces are written straight into the project's result buffer, so 
+    only a small completion record has to be sent back to the server.
+    
+    Arguments:
+        groups (num_batch x numrows array of int): distinct groupings for this 
+            batch, one column per row of the trace block. If group_rows is 
+            given, this is the filename of the group store instead.
+        trace_fname (string): trace block published by the setup thread
+        out (dict): where the results go:
+            - pid (int): ID of the project
+            - fname (string): result buffer made by trace_store.create_buffer()
+            - rids (list of int): ID of each result in the batch
+            - rows (list of int): row of each result in the result buffer
+        is_welch, true_val: output of ttest.classify_groups() for the
+            groupings (default: classify them here)
+        index, sign: output of ttest.unique_groups() for the results, with 
+            index giving the row of each result's grouping in groups 
+            (default: one result per grouping)
+        state (dict): for incremental projects, where the t-test sums are 
+            loaded from and saved to:
+            - path (string): state directory of the project
+            - first (int): index of the trace in the first row of the block
+            - prev_numtraces (int): traces covered by the saved sums (0: none)
+            - save_totals (bool): whether this batch saves the trace totals
+            - is_welch, true_val, ranges: classification and group ranges 
+              of all of the project's results, saved with the trace totals
+              so the next analysis can check the types still hold
+            - old_curves (list of dict): each result's curve fields from the
+              last analysis, when curve is set
+        order (int): highest order of t-test to compute. The sums for every
+            order are collected in the same pass over the traces.
+        curve (bool): whether to also find max |t| over the first n traces at
+            each of the trace counts from curve_counts(). These come from 
+            the running sums as the traces stream past, so they don't need 
+            another pass.
+        group_rows (list of int): rows of the group store holding the 
+            groupings of this batch, when groups is a filename
+    
+    Returns:
+        (dict): out, plus curves (list of dict): each result's curve fields, 
+            or None if curve isn't set
+    """
     try:
-        # Load data
-        tm = cwtm.TraceManager()
-        tm.loadProject(proj_name)
-        traces = np.array([tm.getTrace(i) for i in range(numtraces)])
-        ttrace = [np.zeros(tracelen) for _ in range(2)]
-        split = numtraces/2
+        # Attach to the project's shared trace block
+        traces = trace_store.attach_traces(trace_fname)
+        [numrows, tracelen] = np.shape(traces)
+        if group_rows is not None:
+            # Only this batch's groupings are read from the group store
+            groups = trace_store.attach_traces(groups)[np.asarray(group_rows)]
+        groups = np.asarray(groups)
+        step = chunk_size(tracelen)
         
-        # Count how many unique groups there are
-        group_set = set(group)
-        num_groups = len(group_set)
+        # Groupings with 2 values use a Welch t-test, others the Student t-test
+        if is_welch is None:
+            [is_welch, true_val] = ttest.classify_groups(groups)
+        if index is None:
+            index = np.arange(len(groups))
+            sign = np.ones(len(groups), dtype=int)
         
-        # If we have 2 groups, set up a Welch t-test
-        if num_groups == 2:
-            true_val = group_set.pop()
-            for ig in range(len(group)):
-                group[ig] = (group[ig] == true_val)
-            ttrace[0] = welch_ttest(group[:split], traces[:split])
-            ttrace[1] = welch_ttest(group[split:], traces[split:])
+        first = 0
+        prev_numtraces = 0
+        if state is not None:
+            first = state['first']
+            prev_numtraces = state['prev_numtraces']
+        numtraces = first + numrows
+        split = numtraces/2
+        prev_split = prev_numtraces/2
         
-        # Otherwise, default to the Student t-test
+        base = None
+        if prev_numtraces > 0:
+            # Pick up the sums where the last analysis left off
+            totals = state_store.load_state(state_store.totals_fname(state['path'], prev_numtraces))
+            offset = totals['offset']
+            saved = [state_store.load_state(state_store.result_fname(state['path'], rid, prev_numtraces)) for rid in out['rids']]
+            base = []
+            for h in range(2):
+                b = ttest.TTestAccumulator(is_welch[index], true_val[index], tracelen, offset, order)
+                b.load_totals(dict((k, totals['h%d_%s' % (h, k)]) for k in b.total_keys))
+                b.load_test_states([dict((k[3:], sv[k]) for k in sv if k.startswith('h%d_' % h)) for sv in saved])
+                base.append(b)
         else:
-            ttrace[0] = student_ttest(group[:split], traces[:split])
-            ttrace[1] = student_ttest(group[split:], traces[split:])
-                
-        trace_comb = np.zeros((len(ttrace[0])))
-        for j in range(len(ttrace[0])):
-            if ttrace[0][j] * ttrace[1][j] < 0:
-                trace_comb[j] = 0
-            elif ttrace[0][j] > 0:
-                trace_comb[j] = min(ttrace[0][j], ttrace[1][j])
-            else:
-                trace_comb[j] = max(ttrace[0][j], ttrace[1][j])
-        trace_comb = np.abs(trace_comb)
-        
-        # Copy data into results
-        res.data = {
-            'trace_0': list(ttrace[0]),
-            'trace_1': list(ttrace[1]),
-            'trace_c': list(trace_comb)
-        }
-        res.status = "finished"
-        return res
+            offset = np.mean(traces[:min(step, numrows)], axis=0, dtype=np.float64)
+            
+        def results_ttest(a, d, b=None):
+            # t-tests of order d for every result from the unique sums in a,
+            # plus the per-result sums in b if there are any
+            if state is None:
+                # Fan the t-tests out to every result that shares a grouping
+                return sign[:, None] * a.ttest(d)[index]
+            a = a.expand(index, sign)
+            if b is not None:
+                a.merge(b)
+            return a.ttest(d)
+            
+        # Sample the t-test curves of the traces seen so far
+        counts = [c for c in curve_counts(numtraces) if c > prev_numtraces] if curve else []
+        points = [[] for _ in range(order)]
+        def record(n):
+            cum = ttest.TTestAccumulator(is_welch, true_val, tracelen, offset, order)
+            cum.merge(acc[0])
+            cum.merge(acc[1])
+            cum_base = None
+            if base is not None:
+                cum_base = ttest.TTestAccumulator(base[0].is_welch, base[0].true_val, tracelen, offset, order)
+                cum_base.merge(base[0])
+                cum_base.merge(base[1])
+            for d in range(1, order + 1):
+                t = np.abs(results_ttest(cum, d, cum_base))
+                points[d-1].append((n, np.max(t, axis=1), np.argmax(t, axis=1)))
+            
+        # Stream each half of the traces through its accumulator. When traces 
+        # have been added, the split moves: traces [prev_split, split) move 
+        # from the second half to the first, and the new traces are added to
+        # whichever half they now belong to.
+        def feed(a, start, stop):
+            for c in counts:
+                if start < c <= stop:
+                    ttest.stream_ttest(a, groups, traces, start - first, c - first, step)
+                    record(c)
+                    start = c
+            return ttest.stream_ttest(a, groups, traces, start - first, max(stop, start) - first, step)
+            
+        acc = [ttest.TTestAccumulator(is_welch, true_val, tracelen, offset, order) for _ in range(2)]
+        moved = feed(ttest.TTestAccumulator(is_welch, true_val, tracelen, offset, order), prev_split, min(split, prev_numtraces))
+        acc[0].merge(moved)
+        acc[1].merge(moved, -1)
+        feed(acc[0], max(prev_numtraces, prev_split), split)
+        feed(acc[1], max(prev_numtraces, split), numtraces)
+        
+        if state is None:
+            ttrace = [[results_ttest(acc[h], d) for h in range(2)] for d in range(1, order + 1)]
+        else:
+            # The saved sums are per result, so expand the sums first
+            acc = [acc[h].expand(index, sign) for h in range(2)]
+            if base is not None:
+                for h in range(2):
+                    base[h].merge(acc[h])
+                acc = base
+            ttrace = [[acc[0].ttest(d), acc[1].ttest(d)] for d in range(1, order + 1)]
+            
+            # Save the sums so that the next analysis can extend them
+            for i, rid in enumerate(out['rids']):
+                arrays = {}
+                for h in range(2):
+                    for k, v in acc[h].test_state(i).items():
+                        arrays['h%d_%s' % (h, k)] = v
+                state_store.save_state(state_store.result_fname(state['path'], rid, numtraces), arrays)
+            if state['save_totals']:
+                arrays = {
+                    'offset': offset,
+                    'is_welch': state['is_welch'],
+                    'true_val': state['true_val'],
+                    'group_lo': state['ranges'][0],
+                    'group_hi': state['ranges'][1],
+                    'two_vals': state['ranges'][2],
+                }
+                for h in range(2):
+                    for k, v in acc[h].totals().items():
+                        arrays['h%d_%s' % (h, k)] = v
+                state_store.save_state(state_store.totals_fname(state['path'], numtraces), arrays)
+        
+        trace_comb = [ttest.combine_halves(t0, t1) for [t0, t1] in ttrace]
+        
+        # Copy data into the result buffer
+        buf = trace_store.attach_buffer(out['fname'])
+        rows = np.asarray(out['rows'], dtype=int)
+        buf[rows, 0] = ttrace[0][0]
+        buf[rows, 1] = ttrace[0][1]
+        for d in range(1, order + 1):
+            buf[rows, d + 1] = trace_comb[d-1]
+        buf.flush()
+        del buf
+        
+        curves = None
+        if curve:
+            curves = []
+            for i in range(len(rows)):
+                old_curves = {}
+                if state is not None and 'old_curves' in state:
+                    old_curves = state['old_curves'][i]
+                curves.append({})
+                for d in range(1, order + 1):
+                    key = 'curve' if d == 1 else 'curve_%d' % d
+                    curves[i][key] = merge_curve(old_curves.get(key), prev_numtraces, numtraces,
+                        [(n, t_max[i], i_max[i]) for (n, t_max, i_max) in points[d-1]])
+        return dict(out, curves=curves)
     except Exception as e:
         print traceback.format_exc()
+        return {'pid':out['pid'], 'status':'failed (error in t-test)'}
+    
+def curve_counts(numtraces):
+    """Trace counts where the t-test curves are sampled.
+    
+    This is a geometric series from curve_start with a ratio of curve_ratio,
+    followed by numtraces itself.
+    """
+    counts = []
+    n = float(curve_start)
+    while int(round(n)) < numtraces:
+        c = int(round(n))
+        if not counts or c != counts[-1]:
+            counts.append(c)
+        n *= curve_ratio
+    counts.append(numtraces)
+    return counts
+    
+def merge_curve(old_curve, prev_numtraces, numtraces, points):
+    """Build the curve field of a result from its sampled points.
+    
+    When saved sums are extended, the points up to prev_numtraces can't be
+    sampled again, so the ones that are still on the series are kept from
+    the result's old curve.
+    
+    Arguments:
+        old_curve (dict): curve field from the last analysis (or None)
+        prev_numtraces (int): traces covered by the saved sums
+        numtraces (int): traces in the project
+        points (list of (n, t_max, i_max)): new points, with n > prev_numtraces
+    
+    Returns:
+        (dict) with lists 'numtraces', 't_max' and 'i_max': the largest |t| 
+            over the first n traces, and where it was, for each sampled n
+    """
+    ret = {'numtraces': [], 't_max': [], 'i_max': []}
+    if old_curve is not None:
+        keep = set(c for c in curve_counts(numtraces) if c <= prev_numtraces)
+        for j, n in enumerate(old_curve['numtraces']):
+            if n in keep:
+                ret['numtraces'].append(n)
+                ret['t_max'].append(old_curve['t_max'][j])
+                ret['i_max'].append(old_curve['i_max'][j])
+    for (n, t_max, i_max) in points:
+        ret['numtraces'].append(int(n))
+        ret['t_max'].append(float(t_max))
+        ret['i_max'].append(int(i_max))
+    return ret
+    
+def chunk_size(tracelen):
+    """Number of traces to load into memory at once in worker_thread.
+    """
+    return max(1, max_chunk_bytes / (8 * 2 * max(tracelen, 1)))
+    
+def batch_size(num_tests, tracelen, max_threads, order=1):
+    """Number of groupings to evaluate in each worker_thread call.
+    
+    Spread the tests over all of the threads, but keep the per-batch sum 
+    matrices within max_batch_bytes. Each order of t-test needs two more 
+    power sums per half.
+    """
+    per_thread = int(math.ceil(float(num_tests) / max(max_threads, 1)))
+    per_mem = max_batch_bytes / (8 * 4 * order * max(tracelen, 1))
+    return max(1, min(per_thread, per_mem))
     
 def start_analysis(arg_dict):
     """After performing the setup procedure, start the t-tests.
@@ -219,55 +616,246 @@ def start_analysis(arg_dict):
     This needs the following arguments:
     - pid (int): ID of the running project
     - res_list (list of results): List of result objects for this project
-    - groups (num_config x numtraces array of int): List of groupings per t-test
+    - group_fname (string): Group store with the grouping of every result
+    - is_welch, true_val: Output of ttest.classify_groups() for every result
+    - ranges: Output of ttest.group_ranges() for every result, over all of 
+      the project's traces
+    - uniq, index, sign: Output of ttest.unique_groups() for every result; 
+      uniq gives the rows of the group store with the distinct groupings
+    - trace_fname (string): Trace block published by the setup thread
+    - first (int): Index of the first trace in the trace block and groups
+    - samples (list of int): Project sample index of each point in the trace
+      block, or None if the traces weren't reduced
+    - numtraces (int): Number of traces in the project
+    - prev_numtraces (int): Number of traces already covered by the saved 
+      t-test sums of the project's results (0 to start from scratch)
+    - fingerprint (string): Fingerprint of the traces and config file
     """
+    pid = arg_dict['pid']
     try:
+        # Check if setup ended successfully; if not, end early
+        setup_ok = arg_dict['setup_ok']
+        if not setup_ok:
+            fail_project(pid, arg_dict['status'])
+            return
+            
         proj_list = shelve_db.get_projects()
         res_list  = shelve_db.get_results()
         # Update the project status
-        pid = arg_dict['pid']
         proj = proj_list[pid]
         status = arg_dict['status']
         proj.status = status
-         
-        # Check if setup ended successfully; if not, end early
-        setup_ok = arg_dict['setup_ok']
-        if not setup_ok:
-            proj.running = False
+            
+        if arg_dict.get('restart'):
+            # The saved sums can't be extended, so analyze every trace
             proj_list[pid] = proj
+            trace_store.release_traces(trace_store.store_fname(store_path, pid))
+            workers.submit(setup_thread, args=(proj, proj.cwproject, proj.config, False), callback=start_shards)
             return
              
-        # Add new results objects and refer to them in project
-        leak_names = arg_dict['leak_names']
-        res_list = []
-        for lname in leak_names:
-            res = Result(proj.id, lname)
-            res_list.append(res)
+        prev_numtraces = arg_dict['prev_numtraces']
+        if prev_numtraces > 0:
+            # Extend the existing results in place
+            res_list = [res_list[rid] for rid in proj.results]
+        else:
+            # Add new results objects and refer to them in project
+            leak_names = arg_dict['leak_names']
+            res_list = []
+            for lname in leak_names:
+                res = Result(proj.id, lname)
+                res_list.append(res)
         rids = [r.id for r in res_list]
         proj.results = rids
         proj.remaining = len(rids)
+        proj.next_numtraces = arg_dict['numtraces']
+        proj.next_fingerprint = arg_dict['fingerprint']
+        proj.samples = arg_dict['samples']
         proj_list[pid] = proj
 
         # Run worker threads
-        groups = arg_dict['groups']
-        numtraces = arg_dict['numtraces']
-        tracelen = arg_dict['tracelen']
-        max_threads = arg_dict['max_threads']
-
-        pool = mp.Pool(max_threads)
-        for i in range(len(groups)):
-            pool.apply_async(worker_thread, args=(groups[i], numtraces, tracelen, proj.cwproject, res_list[i]), callback=update_result)
-        pool.close()
+        group_fname = arg_dict['group_fname']
+        trace_fname = arg_dict['trace_fname']
+        is_welch = arg_dict['is_welch']
+        true_val = arg_dict['true_val']
+        uniq = arg_dict['uniq']
+        index = arg_dict['index']
+        sign = arg_dict['sign']
+        
+        state = None
+        if proj.incremental:
+            state = {
+                'path':state_store.state_dir(state_path, pid),
+                'first':arg_dict['first'],
+                'prev_numtraces':prev_numtraces,
+            }
+
+        tracelen = np.shape(trace_store.attach_traces(trace_fname))[1]
+        step = batch_size(len(uniq), tracelen, workers.num_workers, proj.order)
+        print "Running %d unique t-tests for %d results" % (len(uniq), len(res_list))
+        
+        # The workers write their t-traces here instead of sending them back
+        out_fname = trace_store.buffer_fname(store_path, pid)
+        trace_store.create_buffer(out_fname, (len(res_list), len(result_keys(proj.order)), tracelen))
+
+        for i in range(0, len(uniq), step):
+            j = i + step
+            members = np.flatnonzero((index >= i) & (index < j))
+            out = {
+                'pid':pid,
+                'fname':out_fname,
+                'rids':[rids[m] for m in members],
+                'rows':[int(m) for m in members],
+            }
+            batch_state = None
+            if state is not None:
+                batch_state = dict(state, save_totals=(i == 0))
+                if i == 0:
+                    batch_state['is_welch'] = is_welch
+                    batch_state['true_val'] = true_val
+                    batch_state['ranges'] = arg_dict['ranges']
+                if proj.curve and prev_numtraces > 0:
+                    batch_state['old_curves'] = [dict((k, v) for k, v in res_list[m].data.items() if k.startswith('curve')) for m in members]
+            workers.submit(worker_thread, 
+                args=(group_fname, trace_fname, out, 
+                      is_welch[uniq[i:j]], true_val[uniq[i:j]], index[members] - i, sign[members], batch_state, proj.order, proj.curve, 
+                      [int(u) for u in uniq[i:j]]), 
+                callback=queue_results)
     except:
         print traceback.format_exc()
-        raise    
+        fail_project(pid, "failed (error starting t-tests)")
+
 
+def saved_numtraces(proj, config_fname, tracelen, pt, key):
+    """Find how many traces are covered by a project's saved t-test sums.
+    
+    The sums can only be extended if the project still starts with the same
+    traces, uses the same config file and t-test order, and has sums saved 
+    for every result.
+    
+    Returns:
+        The number of traces that don't need to be processed again, or 0 if
+        the analysis has to start from scratch
+    """
+    n = proj.numtraces
+    if n == 0 or n > len(pt):
+        return 0
+    if state_store.fingerprint(config_fname, tracelen, pt[:n], key[:n], proj.order, proj.windows, proj.decimate) != proj.fingerprint:
+        return 0
+    if not state_store.has_state(state_store.state_dir(state_path, proj.id), proj.results, n):
+        return 0
+    return n
 
-def star_leakage(s):
-    f = s[0]
-    return f(s[1], s[2])
+def find_model(model_name):
+    """Return an instance of the leakage model called model_name, or None.
+    """
+    for m in models.models:
+        if m.name == model_name:
+            return m()
+    return None
+    
+def group_dtype(m1, m2):
+    """Return the smallest unsigned type that fits every grouping in a config.
+    
+    A Hamming distance can't be bigger than the number of bits in both masks,
+    whatever operation is applied to the states.
+    """
+    max_weight = max([bin(m1[i]).count("1") + bin(m2[i]).count("1") for i in range(len(m1))] + [0])
+    return np.uint8 if max_weight <= np.iinfo(np.uint8).max else np.uint16
+    
+def shard_bounds(first, numtraces, max_threads):
+    """Split the traces into contiguous shards of whole cache blocks for the 
+    setup jobs.
+    
+    The first shard starts at the block holding trace first, so it can 
+    include some traces before first; their states come from the cache, but
+    they aren't grouped. The work is spread over as many workers as there 
+    are blocks.
+    
+    Arguments:
+        first (int): index of the first trace to group
+        numtraces (int): number of traces in the project
+        max_threads (int): number of worker processes
+        
+    Returns:
+        list of [start, stop] trace ranges
+    """
+    start = first - first % cache_block_rows
+    num_blocks = int(math.ceil(float(numtraces - start) / cache_block_rows))
+    rows = cache_block_rows * max(1, int(math.ceil(float(num_blocks) / max(max_threads, 1))))
+    return [[i, min(i + rows, numtraces)] for i in range(start, numtraces, rows)]
+    
+def leakage_states(leakage_model, pt, key, points):
+    """Find the states of one cache block of traces at the leakage points in 
+    points.
+    
+    Points that an earlier project found for the same traces and model are 
+    loaded from the cache; the cipher is only run for the rest.
+    
+    Returns:
+        states (IntermediateStore): every point in points
+        cache_fname (string): cache entry of the block, which the caller 
+            keeps when it evicts old entries
+    """
+    numrows = len(pt)
+    states = intermediates.IntermediateStore(numrows)
+    cache_fname = cache_store.cache_dir(cache_path, cache_store.fingerprint(leakage_model.name, pt, key))
+    for [point, column] in cache_store.load_points(cache_fname, points).items():
+        states.add(point, column)
+    missing = points - set(states.names())
+    
+    if missing:
+        if hasattr(leakage_model, 'cipher_batch'):
+            # Run the cipher on every trace at once
+            new_states = intermediates.IntermediateStore.from_batch(leakage_model.cipher_batch(pt, key, missing))
+        else:
+            # Pack each trace's states into the store as they're found, so 
+            # the ints for every trace never exist at the same time
+            rows = (leakage_model.cipher(pt[i], key[i], missing) for i in range(numrows))
+            new_states = intermediates.IntermediateStore.from_rows(rows, numrows)
+        cache_store.save_points(cache_fname, new_states)
+        for point in new_states.names():
+            states.add(point, new_states[point])
+    return states, cache_fname
+    
+def config_group(states, lt1, m1, lt2, m2, op):
+    """Find the grouping of every trace for one test in a config.
+    
+    Returns:
+        (N array of uint): Hamming distance between the two masked states, 
+            after applying the test's operation
+    """
+    # Find internal states (masked)
+    s1 = states.masked(lt1, m1)
+    s2 = states.masked(lt2, m2)
+    
+    # Apply any operations
+    if op[0] == 'L':
+        shft = int(op[1])
+        s2 = intermediates.shift_left(s2, shft)
+    elif op[0] == 'R':
+        shft = int(op[1])
+        s2 = intermediates.shift_right(s2, shft)
+    elif op[0] == 'E':
+        goal = int(op[1], 0)
+        s1 = intermediates.equals(s1, goal).astype(np.uint8)[:, None]
+        s2 = intermediates.equals(s2, goal).astype(np.uint8)[:, None]
+    
+    # Shifted states can be wider than the other side
+    nbytes = max(s1.shape[1], s2.shape[1])
+    s1 = intermediates.pad_bytes(s1, nbytes)
+    s2 = intermediates.pad_bytes(s2, nbytes)
+    return intermediates.hamming_weight(s1 ^ s2)
 
-def setup_thread(proj, fname, config_fname, max_threads):
+def setup_thread(proj, fname, config_fname, extend=True):
+    """Prepare a project for the setup shards.
+    
+    Loads the config and the text/key of every trace, publishes the traces 
+    for the t-tests and makes the project's group store. The leakage and 
+    groupings are found by shard_thread() jobs afterwards.
+    
+    If extend is False, the saved sums of an incremental project are 
+    ignored and every trace is analyzed.
+    """
     try:
         print "Running setup..."
         ret = {'pid':proj.id}
@@ -294,12 +882,7 @@ def setup_thread(proj, fname, config_fname, max_threads):
            
         # Read config file
         [model_name, name, lt1, m1, lt2, m2, op] = load_config(config_fname)
-        leakage_model = None
-        for m in models.models:
-            if m.name == model_name:
-                leakage_model = m()
-                break
-        if leakage_model is None:
+        if find_model(model_name) is None:
             ret['setup_ok'] = False
             ret['status'] = "failed (unrecognized leakage model %s)" % model_name
             return ret
@@ -311,64 +894,231 @@ def setup_thread(proj, fname, config_fname, max_threads):
         print "Loading data..."
         [numtraces, tracelen, pt, key] = load_data(fname)
 
-        print "Calculating leakage..."   
-        p = mp.Pool(8)
-        c = p.map(star_leakage, itertools.izip(itertools.repeat(leakage_model.cipher), pt, key))
-
-        print "Calculating groupings..."
-        groups = []
-                
-        # For each result object:
-        for idx in tqdm(range(num_config)):
-            # Find internal states (masked)
-            s1 = [c[i][lt1[idx]] & m1[idx] for i in range(numtraces)]
-            s2 = [c[i][lt2[idx]] & m2[idx] for i in range(numtraces)]
-            
-            # Apply any operations
-            if op[idx][0] == 'L':
-                shft = int(op[idx][1])
-                s2 = [s2[i] << shft for i in range(numtraces)]
-            elif op[idx][0] == 'R':
-                shft = int(op[idx][1])
-                s2 = [s2[i] >> shft for i in range(numtraces)] 
-            elif op[idx][0] == 'E':
-                goal = int(op[idx][1], 0)
-                s1 = [1 if s1[i] == goal else 0 for i in range(numtraces)]
-                s2 = [1 if s2[i] == goal else 0 for i in range(numtraces)]
-
-            # Find groups
-            group = [calculate_HW(s1[i] ^ s2[i]) for i in range(numtraces)]
-            groups.append(group)
+        # Only the new traces (and the ones that move between halves) need to
+        # be processed if we can extend the saved t-test sums
+        prev_numtraces = 0
+        fingerprint = None
+        if proj.incremental:
+            if extend:
+                prev_numtraces = saved_numtraces(proj, config_fname, tracelen, pt, key)
+            fingerprint = state_store.fingerprint(config_fname, tracelen, pt, key, proj.order, proj.windows, proj.decimate)
+            if prev_numtraces > 0:
+                print "Extending saved results from %d to %d traces" % (prev_numtraces, numtraces)
+        first = prev_numtraces/2
+        numrows = numtraces - first
+
+        # Publish the traces once for all of the worker threads
+        print "Publishing traces..."
+        trace_fname = trace_store.store_fname(store_path, proj.id)
+        trace_store.publish_traces(fname, trace_fname, first, proj.windows, proj.decimate)
+        samples = None
+        if proj.windows or proj.decimate > 1:
+            samples = [int(i) for i in trace_store.sample_points(tracelen, proj.windows, proj.decimate)]
+            print "Analyzing %d of %d points" % (len(samples), tracelen)
+
+        # Split the leakage and grouping work into shards of traces, which 
+        # write their groupings into one store for the whole project
+        group_fname = trace_store.group_fname(store_path, proj.id)
+        trace_store.create_buffer(group_fname, (num_config, numrows), group_dtype(m1, m2))
+        shards = shard_bounds(first, numtraces, workers.num_workers)
+        print "Splitting setup of %d traces into %d shards" % (numrows, len(shards))
+        if shards:
+            pt = pt[shards[0][0]:]
+            key = key[shards[0][0]:]
             
-        print "Setup complete"
         ret = {
             'setup_ok':True,
-            'status':'running',
+            'status':'setup',
             'pid':proj.id,
+            'model_name':model_name,
+            'config':[lt1, m1, lt2, m2, op],
+            'pt':pt,
+            'key':key,
+            'shards':shards,
+            'group_fname':group_fname,
             'leak_names':name,
-            'groups':groups,
+            'trace_fname':trace_fname,
+            'first':first,
+            'samples':samples,
             'numtraces':numtraces,
-            'tracelen':tracelen,
-            'max_threads':max_threads,
+            'prev_numtraces':prev_numtraces,
+            'fingerprint':fingerprint,
         }
         return ret
     except:
         print traceback.format_exc()
-        raise
-
-class NoDaemonProcess(mp.Process):
-    # make 'daemon' attribute always return False
-    def _get_daemon(self):
+        return {'pid':proj.id, 'setup_ok':False, 'status':'failed (error in setup)'}
+        
+def shard_thread(pid, model_name, config, pt, key, start, first, group_fname):
+    """Find the groupings of one shard of traces for every test in a config.
+    
+    The states are found one cache block at a time, so the blocks can be 
+    reused by any project with the same traces.
+    
+    Arguments:
+        pid (int): ID of the project being set up
+        model_name (string): name of the leakage model
+        config (list): lt1, m1, lt2, m2 and op from load_config()
+        pt, key (N x nbytes arrays of uint8): text and key of each trace in 
+            the shard
+        start (int): index of the first trace in the shard, at the start of 
+            a cache block
+        first (int): index of the trace in the first column of the group 
+            store; traces before it are skipped
+        group_fname (string): group store made by setup_thread()
+    
+    Returns:
+        dict with pid, setup_ok and, if that's False, the failed status
+    """
+    try:
+        [lt1, m1, lt2, m2, op] = config
+        leakage_model = find_model(model_name)
+        points = set(lt1) | set(lt2)
+        
+        groups = trace_store.attach_buffer(group_fname)
+        entries = []
+        for i in range(0, len(pt), cache_block_rows):
+            j = min(i + cache_block_rows, len(pt))
+            [states, cache_fname] = leakage_states(leakage_model, pt[i:j], key[i:j], points)
+            entries.append(cache_fname)
+            skip = max(first - (start + i), 0)
+            for idx in range(len(lt1)):
+                group = config_group(states, lt1[idx], m1[idx], lt2[idx], m2[idx], op[idx])
+                groups[idx, start + i + skip - first:start + j - first] = group[skip:]
+            del states
+        groups.flush()
+        
+        # Make room for the new entries once the whole shard is cached
+        cache_store.evict(cache_path, max_cache_bytes, keep=entries)
+        return {'pid':pid, 'setup_ok':True}
+    except:
+        print traceback.format_exc()
+        return {'pid':pid, 'setup_ok':False, 'status':'failed (error in setup shard)'}
+        
+def types_unchanged(totals, ranges):
+    """Check that extending saved sums keeps every test's t-test type.
+    
+    A Welch test and a Student test collect different sums, so saved sums 
+    can't be extended if the new traces change the type of any test: a 
+    constant grouping that gets a second value, or a Welch grouping that gets
+    a third.
+    
+    Arguments:
+        totals (dict): saved trace totals, with the ranges and types of the 
+            traces they cover
+        ranges: ttest.group_ranges() of the traces being added
+    """
+    if 'group_lo' not in totals:
+        # Saved before the ranges were, so the types can't be checked
         return False
-    def _set_daemon(self, value):
-        pass
-    daemon = property(_get_daemon, _set_daemon)
-
-# We sub-class multiprocessing.pool.Pool instead of multiprocessing.Pool
-# because the latter is only a wrapper function, not a proper class.
-class MyPool(multiprocessing.pool.Pool):
-    Process = NoDaemonProcess
-
+    old = [totals['group_lo'], totals['group_hi'], totals['two_vals']]
+    [is_welch, true_val] = ttest.classify_ranges(ttest.merge_ranges(old, ranges))
+    if not np.array_equal(is_welch, totals['is_welch']):
+        return False
+    return np.array_equal(true_val[is_welch], totals['true_val'][is_welch])
+    
+def finish_setup(arg_dict):
+    """Find the distinct groupings once every setup shard is done.
+    
+    If the new traces of an incremental project change the type of any 
+    t-test, the saved sums can't be used; arg_dict comes back with restart 
+    set instead, and the setup is run again over every trace.
+    
+    The group store stays on disk for the t-test jobs, which each read the 
+    rows of their own groupings.
+    
+    Returns:
+        arg_dict with the distinct groupings and t-test types added, as 
+        start_analysis() needs them
+    """
+    try:
+        print "Finding unique groupings..."
+        group_fname = arg_dict['group_fname']
+        groups = trace_store.attach_traces(group_fname)
+        ranges = ttest.group_ranges(groups)
+        prev_numtraces = arg_dict['prev_numtraces']
+        if prev_numtraces > 0:
+            # The types have to be decided over every trace, including the 
+            # ones that are only in the saved sums
+            totals = state_store.load_state(state_store.totals_fname(state_store.state_dir(state_path, arg_dict['pid']), prev_numtraces))
+            if not types_unchanged(totals, ranges):
+                del groups
+                trace_store.release_traces(group_fname)
+                print "T-test types changed with the new traces; starting over"
+                return dict(arg_dict, restart=True)
+            ranges = ttest.merge_ranges([totals['group_lo'], totals['group_hi'], totals['two_vals']], ranges)
+        [is_welch, true_val] = ttest.classify_ranges(ranges)
+        [uniq, index, sign] = ttest.unique_groups(groups, is_welch, true_val)
+        print "Found %d unique groupings in %d tests" % (len(uniq), len(groups))
+        
+        ret = dict(arg_dict, 
+            status='running',
+            is_welch=is_welch,
+            true_val=true_val,
+            ranges=ranges,
+            uniq=uniq,
+            index=index,
+            sign=sign,
+        )
+        del groups
+        print "Setup complete"
+        return ret
+    except:
+        print traceback.format_exc()
+        return dict(arg_dict, setup_ok=False, status='failed (error finding unique groupings)')
+        
+def start_shards(arg_dict):
+    """After the setup job, queue a shard_thread() job for each shard.
+    """
+    pid = arg_dict['pid']
+    try:
+        if not arg_dict['setup_ok']:
+            start_analysis(arg_dict)
+            return
+        
+        # The shards get their own slice of the text and key, which starts at
+        # the first shard
+        arg_dict = dict(arg_dict)
+        pt = arg_dict.pop('pt')
+        key = arg_dict.pop('key')
+        shards = arg_dict['shards']
+        if not shards:
+            workers.submit(finish_setup, args=(arg_dict,), callback=start_analysis)
+            return
+        pending_setup[pid] = [len(shards), arg_dict]
+        base = shards[0][0]
+        for [i, j] in shards:
+            workers.submit(shard_thread, 
+                args=(pid, arg_dict['model_name'], arg_dict['config'], pt[i-base:j-base], key[i-base:j-base], i, arg_dict['first'], arg_dict['group_fname']), 
+                callback=shard_done)
+    except:
+        print traceback.format_exc()
+        fail_project(pid, "failed (error starting setup shards)")
+        
+def shard_done(record):
+    """Count a finished setup shard, and finish the setup after the last one.
+    """
+    pid = record['pid']
+    try:
+        if pid not in pending_setup:
+            # The project already failed
+            return
+        pending = pending_setup[pid]
+        pending[0] -= 1
+        if not record['setup_ok']:
+            pending[1].update(setup_ok=False, status=record['status'])
+        if pending[0] > 0:
+            return
+            
+        del pending_setup[pid]
+        arg_dict = pending[1]
+        if not arg_dict['setup_ok']:
+            start_analysis(arg_dict)
+            return
+        workers.submit(finish_setup, args=(arg_dict,), callback=start_analysis)
+    except:
+        print traceback.format_exc()
+        fail_project(pid, "failed (error in setup shard)")
 
 def start_setup(proj):
     """Start the analysis setup thread.
@@ -376,33 +1126,54 @@ def start_setup(proj):
     Note that the values in the Project object are only read once here - any 
     changes during the analysis will have no effect.
     
+    The setup and the t-tests run as jobs in the shared worker service.
+    
     Arguments:
         proj (Project): the project to be used (in particular, the cwproject and
-            config filenames and the number of threads are used to run the 
-            analysis)
+            config filenames are used to run the analysis)
     """
     
     proj_list = shelve_db.get_projects()
     proj.status = "started"
+    proj.archived = False
     proj_list[proj.id] = proj
     cwp_fname = proj.cwproject
     cfg_fname = proj.config
-    num_threads = proj.num_threads
     
-    pool = MyPool(1)
-    pool.apply_async(setup_thread, args=(proj, cwp_fname, cfg_fname, num_threads), callback=start_analysis)
-    pool.close()
+    workers.submit(setup_thread, args=(proj, cwp_fname, cfg_fname), callback=start_shards)
 
     
 # Test code starts here
-class DummyResult(object):
-    """Dummy class to mock a Result() object.
+def publish_test_traces(dirname, fname='xmega-aes-small.npy', **kwargs):
+    """Publish the traces of the test project into dirname.
+    
+    The tests publish into a temporary directory that they delete when 
+    they're done, so they never leave trace blocks behind.
+    
+    Returns:
+        trace_fname, numtraces, tracelen
+    """
+    trace_fname = os.path.join(dirname, fname)
+    [numtraces, tracelen] = trace_store.publish_traces('test_data/xmega-aes-small.cwp', trace_fname, **kwargs)
+    return trace_fname, numtraces, tracelen
+    
+def run_test_worker(group, trace_fname, **kwargs):
+    """Run worker_thread on one grouping and return the result's data.
     
-    Only has data (dictionary) and status (string).
+    Sets up a result buffer with one row, like start_analysis() would.
     """
-    def __init__(self):
-        self.data = {}
-        self.status = None
+    out_fname = os.path.join(os.path.dirname(trace_fname), 'results.npy')
+    tracelen = np.shape(trace_store.attach_traces(trace_fname))[1]
+    trace_store.create_buffer(out_fname, (1, len(result_keys(kwargs.get('order', 1))), tracelen))
+    out = {'pid':0, 'fname':out_fname, 'rids':[0], 'rows':[0]}
+    record = worker_thread([group], trace_fname, out, **kwargs)
+    
+    buf = trace_store.attach_traces(out_fname)
+    data = dict((k, list(buf[0, j])) for j, k in enumerate(result_keys(buf.shape[1] - 2)))
+    if record['curves'] is not None:
+        data.update(record['curves'][0])
+    trace_store.release_traces(out_fname)
+    return data
         
 def test_welch_ttest(plot=False):
     """Test the Welch T-Test analysis with some random data.
@@ -410,34 +1181,33 @@ def test_welch_ttest(plot=False):
     Loads a small .cwp and runs a t-test with 2 groups.
     """
     # Load data
-    proj_name = 'test_data/xmega-aes-small.cwp'
-    tm = cwtm.TraceManager()
-    tm.loadProject(proj_name)
-    numtraces = tm.numTraces()
-    tracelen = tm.numPoints()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        [trace_fname, numtraces, tracelen] = publish_test_traces(tmp_dir)
     
-    # Set up mock data
-    group = [0, 1] * (numtraces/2)
-    res = DummyResult()
+        # Set up mock data
+        group = [0, 1] * (numtraces/2)
     
-    # Run analysis
-    worker_thread(group, numtraces, tracelen, proj_name, res)
-    ttrace = res.data['trace_c']
+        # Run analysis
+        data = run_test_worker(group, trace_fname)
+        ttrace = data['trace_c']
     
-    # Optional: plot output - confirm max t ~ 2.3 
-    if plot:
-        import matplotlib.pyplot as plt
-        plt.plot(res.data['trace_c'])
-        plt.grid()
-        plt.show()
+        # Optional: plot output - confirm max t ~ 2.3 
+        if plot:
+            import matplotlib.pyplot as plt
+            plt.plot(data['trace_c'])
+            plt.grid()
+            plt.show()
     
-    # Check output
-    t_max = max(ttrace)
-    if not (2.0 < t_max < 2.5):
-        raise ValueError("Expected 2.0 < t_max < 2.5; got %f" % t_max)
+        # Check output
+        t_max = max(ttrace)
+        if not (2.0 < t_max < 2.5):
+            raise ValueError("Expected 2.0 < t_max < 2.5; got %f" % t_max)
     
-    # If we get here, all is good
-    print "Welch T-Test: [PASS]"
+        # If we get here, all is good
+        print "Welch T-Test: [PASS]"
+    finally:
+        shutil.rmtree(tmp_dir)
     
 def test_1group_ttest(plot=False):
     """Make sure the ttest doesn't fail with one group
@@ -445,74 +1215,141 @@ def test_1group_ttest(plot=False):
     Loads a small .cwp and runs a t-test with 1 group
     """
     # Load data
-    proj_name = 'test_data/xmega-aes-small.cwp'
-    tm = cwtm.TraceManager()
-    tm.loadProject(proj_name)
-    numtraces = tm.numTraces()
-    tracelen = tm.numPoints()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        [trace_fname, numtraces, tracelen] = publish_test_traces(tmp_dir)
     
-    # Set up mock data
-    group = [0] * (numtraces)
-    res = DummyResult()
+        # Set up mock data
+        group = [0] * (numtraces)
     
-    # Run analysis
-    worker_thread(group, numtraces, tracelen, proj_name, res)
+        # Run analysis
+        data = run_test_worker(group, trace_fname)
     
-    # Check output
-    ttrace = res.data['trace_c']
-    t_max = max(ttrace)
-    #if t_max > 0:
-    #    raise ValueError("Expected t_max = 0; got %f" % t_max)
+        # Check output
+        ttrace = data['trace_c']
+        t_max = max(ttrace)
+        #if t_max > 0:
+        #    raise ValueError("Expected t_max = 0; got %f" % t_max)
     
-    # Optional: plot output - confirm max t ~ 2.3 
-    if plot:
-        import matplotlib.pyplot as plt
-        plt.plot(res.data['trace_c'])
-        plt.grid()
-        plt.show()
+        # Optional: plot output - confirm max t ~ 2.3 
+        if plot:
+            import matplotlib.pyplot as plt
+            plt.plot(data['trace_c'])
+            plt.grid()
+            plt.show()
     
-    # If we get here, all is good
-    print "1 group T-Test: [PASS]"
+        # If we get here, all is good
+        print "1 group T-Test: [PASS]"
+    finally:
+        shutil.rmtree(tmp_dir)
     
 def test_0dof_ttest(plot=False):
     """Make sure the ttest doesn't fail with a group with size 1
     """
     # Load data
-    proj_name = 'test_data/xmega-aes-small.cwp'
-    tm = cwtm.TraceManager()
-    tm.loadProject(proj_name)
-    numtraces = tm.numTraces()
-    tracelen = tm.numPoints()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        [trace_fname, numtraces, tracelen] = publish_test_traces(tmp_dir)
+    
+        # Set up mock data
+        group = [0] * (numtraces)
+        group[0] = 1
+    
+        # Run analysis
+        data = run_test_worker(group, trace_fname)
+        ttrace = data['trace_c']
+    
+        # Optional: plot output - confirm max t ~ 2.3 
+        if plot:
+            import matplotlib.pyplot as plt
+            plt.plot(data['trace_c'])
+            plt.grid()
+            plt.show()
     
-    # Set up mock data
-    group = [0] * (numtraces)
-    group[0] = 1
-    res = DummyResult()
+        # Check output
+        t_max = max(ttrace)
+        if t_max > 0:
+            raise ValueError("Expected t_max = 0; got %f" % t_max)
     
-    # Run analysis
-    worker_thread(group, numtraces, tracelen, proj_name, res)
-    ttrace = res.data['trace_c']
+        # If we get here, all is good
+        print "0 DOF group T-Test: [PASS]"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_ttest_curve():
+    """Make sure the t-test curve ends at the t-test over all of the traces
+    """
+    # Load data
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        [trace_fname, numtraces, tracelen] = publish_test_traces(tmp_dir)
     
-    # Optional: plot output - confirm max t ~ 2.3 
-    if plot:
-        import matplotlib.pyplot as plt
-        plt.plot(res.data['trace_c'])
-        plt.grid()
-        plt.show()
+        # Set up mock data
+        group = [0, 1] * (numtraces/2)
     
-    # Check output
-    t_max = max(ttrace)
-    if t_max > 0:
-        raise ValueError("Expected t_max = 0; got %f" % t_max)
+        # Run analysis
+        data = run_test_worker(group, trace_fname, curve=True)
+        curve = data['curve']
     
+        # Check output
+        if curve['numtraces'] != curve_counts(numtraces):
+            raise ValueError("Curve sampled at the wrong trace counts: %s" % curve['numtraces'])
+        traces = trace_store.attach_traces(trace_fname)
+        t_full = np.abs(ttest.batch_welch_ttest([np.array(group) == 0], traces)[0])
+        if not np.isclose(curve['t_max'][-1], np.max(t_full)):
+            raise ValueError("Expected t_max = %f at the end of the curve; got %f" % (np.max(t_full), curve['t_max'][-1]))
+    
+        # If we get here, all is good
+        print "T-Test Curve: [PASS]"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_sample_windows():
+    """Make sure windowed, decimated traces average the right samples
+    """
+    # Load data
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        [trace_fname, numtraces, tracelen] = publish_test_traces(tmp_dir)
+        windows = [[10, 50], [100, 111]]
+        [window_fname, numtraces, window_len] = publish_test_traces(tmp_dir, 'xmega-aes-small-window.npy', windows=windows, decimate=4)
+        
+        # Check output
+        full = trace_store.attach_traces(trace_fname)
+        reduced = trace_store.attach_traces(window_fname)
+        if window_len != 10 + 3:
+            raise ValueError("Expected 13 points; got %d" % window_len)
+        if not np.allclose(reduced[:, 0], np.mean(full[:, 10:14], axis=1)):
+            raise ValueError("First point isn't the mean of samples 10-13")
+        if not np.allclose(reduced[:, -1], np.mean(full[:, 108:111], axis=1)):
+            raise ValueError("Last point isn't the mean of samples 108-110")
+        
+        # If we get here, all is good
+        print "Sample Windows: [PASS]"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_shard_bounds():
+    """Make sure setup shards are made of whole cache blocks
+    """
+    n = cache_block_rows
+    shards = shard_bounds(n + 5, 3*n + 10, 2)
+    if shards != [[n, 3*n], [3*n, 3*n + 10]]:
+        raise ValueError("Shards aren't aligned to cache blocks: %s" % shards)
+    if shard_bounds(0, 10, 4) != [[0, 10]]:
+        raise ValueError("Expected one shard for one block")
+        
     # If we get here, all is good
-    print "0 DOF group T-Test: [PASS]"
+    print "Shard Bounds: [PASS]"
 
 if __name__ == "__main__":
     tests = [
         test_welch_ttest,
         test_1group_ttest,
         test_0dof_ttest,
+        test_ttest_curve,
+        test_sample_windows,
+        test_shard_bounds,
     ]
     
     from timeit import default_timer as timer
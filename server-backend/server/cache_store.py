@@ -0,0 +1,155 @@
+"""
+cache_store.py
+
+On-disk cache of the leakage states computed during setup, shared by every
+project that analyzes the same traces with the same leakage model
+"""
+
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+def fingerprint(model_name, pt, key):
+    """Identify the inputs of a leakage model.
+
+    The states only depend on the model and the text/key of every trace, so
+    these are all that's hashed. If the traces in a project change, so does
+    the fingerprint, and the old states are never used again.
+    """
+    h = hashlib.sha1()
+    h.update(model_name)
+    for a in [pt, key]:
+        a = np.ascontiguousarray(a)
+        h.update(str(a.shape))
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+def cache_dir(cache_path, fp):
+    """Return the directory holding the cached states for fingerprint fp.
+    """
+    return os.path.join(cache_path, fp)
+
+def point_fname(dirname, name):
+    """Return the filename of the cached states at leakage point name.
+    """
+    return os.path.join(dirname, hashlib.sha1(name).hexdigest() + '.npy')
+
+def load_points(dirname, points):
+    """Memory-map the cached states of every point in points that has them.
+
+    Returns:
+        dict mapping point names to read-only (N x nbytes) uint8 arrays
+    """
+    ret = {}
+    for name in points:
+        fname = point_fname(dirname, name)
+        if os.path.exists(fname):
+            ret[name] = np.load(fname, mmap_mode='r')
+    if ret:
+        # Mark the entry as recently used
+        os.utime(dirname, None)
+    return ret
+
+def save_points(dirname, states):
+    """Write the states of every point in an IntermediateStore to the cache.
+
+    Each file is written under a unique temporary name and renamed when 
+    complete, so other setup jobs never load a partial one, even if they're 
+    caching the same states at the same time.
+    """
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Another setup job made it first
+            pass
+    for name in states.names():
+        fname = point_fname(dirname, name)
+        [fd, tmp_fname] = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, states[name])
+        os.rename(tmp_fname, fname)
+    os.utime(dirname, None)
+
+def cache_size(dirname):
+    """Return the number of bytes used by one cache entry.
+    """
+    return sum(os.path.getsize(f) for f in glob.glob(os.path.join(dirname, '*.npy')))
+
+def evict(cache_path, max_bytes, keep=None):
+    """Delete the least recently used entries until the cache fits in
+    max_bytes.
+
+    Arguments:
+        cache_path (string): directory holding every cache entry
+        max_bytes (int): most space the cache can use
+        keep (list of strings): entry directories that are never deleted 
+            (the ones being used right now), even if they're bigger than 
+            max_bytes on their own
+    """
+    keep = set(os.path.abspath(k) for k in keep or [])
+    if not os.path.isdir(cache_path):
+        return
+    entries = []
+    for fp in os.listdir(cache_path):
+        dirname = cache_dir(cache_path, fp)
+        if os.path.isdir(dirname):
+            entries.append((os.path.getmtime(dirname), dirname, cache_size(dirname)))
+    entries.sort()
+    total = sum(e[2] for e in entries)
+    for [mtime, dirname, size] in entries:
+        if total <= max_bytes:
+            break
+        if os.path.abspath(dirname) in keep:
+            continue
+        print "Evicting cached states %s (%.1f MB)" % (dirname, size / 2.0**20)
+        shutil.rmtree(dirname, ignore_errors=True)
+        total -= size
+
+def test_cache_store():
+    import tempfile
+    import intermediates
+    cache_path = tempfile.mkdtemp()
+    try:
+        pt = np.arange(32, dtype=np.uint8).reshape(2, 16)
+        key = np.zeros((2, 16), dtype=np.uint8)
+        fp = fingerprint('AES128', pt, key)
+        if fp == fingerprint('AES128', pt, key + 1) or fp == fingerprint('AES256', pt, key):
+            raise ValueError("Fingerprint doesn't depend on the inputs")
+
+        dirname = cache_dir(cache_path, fp)
+        store = intermediates.IntermediateStore.from_batch({'a':pt, 'b':pt ^ 0xff})
+        save_points(dirname, store)
+        loaded = load_points(dirname, ['a', 'c'])
+        if sorted(loaded.keys()) != ['a'] or not np.array_equal(loaded['a'], pt):
+            raise ValueError("Loaded states differ from the saved ones")
+        del loaded
+        if [f for f in os.listdir(dirname) if not f.endswith('.npy')]:
+            raise ValueError("Temporary files were left in the cache")
+
+        # Make another entry that's newer than the first one
+        os.utime(dirname, (time.time() - 10, time.time() - 10))
+        other = cache_dir(cache_path, fingerprint('AES128', pt, key + 1))
+        save_points(other, store)
+        evict(cache_path, cache_size(other), keep=[other])
+        if os.path.exists(dirname) or not os.path.exists(other):
+            raise ValueError("Evicted the wrong entry")
+        evict(cache_path, 0, keep=[other])
+        if not os.path.exists(other):
+            raise ValueError("Evicted the entry in use")
+    finally:
+        shutil.rmtree(cache_path)
+
+    print "Cache Store: [PASS]"
+
+if __name__ == "__main__":
+    tests = [
+        test_cache_store,
+    ]
+
+    for t in tests:
+        t()
@@ -4,13 +4,18 @@ interface.py
 Flask routing to control project/results
 """
 
-from flask import Blueprint, jsonify, abort, make_response, request, url_for
+from flask import Blueprint, jsonify, abort, make_response, request, url_for, send_file
 from shelve_db import Project, Result
 import shelve_db
+import sql_db
 import analysis
+import workers
+import writer
+import result_store
+import io
 import os
+import numpy as np
 import chipwhisperer.common.api.TraceManager as cwtm
-from tqdm import *
 
 if_blueprint = Blueprint('interface', __name__)
 
@@ -19,19 +24,30 @@ randomID = False
 tpath = '.'
 cpath = '.'
 
-def init(db_path, rid, trace_path, config_path):
+def init(db_path, rid, trace_path, config_path, flush_interval=None):
     global randomID
     randomID = rid
     
-    projects_fname = os.path.join(db_path, 'projects.db')
-    results_fname  = os.path.join(db_path, 'results.db')
+    projects_fname = os.path.join(db_path, 'projects.sqlite')
+    results_fname  = os.path.join(db_path, 'results.sqlite')
+    # Bring over the projects from the old shelve databases the first time
+    for fname in [projects_fname, results_fname]:
+        old_fname = os.path.splitext(fname)[0] + '.db'
+        if not os.path.exists(fname) and sql_db.shelve_exists(old_fname):
+            n = sql_db.migrate_shelve(old_fname, fname)
+            print "Migrated %d items from %s" % (n, old_fname)
     shelve_db.open_db(projects_fname, results_fname)
     #shelve_db.open_db(None, None)
+    analysis.init(db_path)
+    workers.init()
+    writer.init(flush_interval)
     
     globals()['tpath'] = trace_path
     globals()['cpath'] = config_path
     
 def close():
+    workers.close()
+    writer.close()
     shelve_db.close_db()
   
 def get_public_project(project):
@@ -48,6 +64,14 @@ def get_public_project(project):
         'results':[url_for('interface.get_result', rid=r, _external=True) for r in project.results],
         'status':project.status,
         'title':project.title,
+        'incremental':project.incremental,
+        'order':project.order,
+        'curve':project.curve,
+        'windows':project.windows,
+        'decimate':project.decimate,
+        'samples':project.samples,
+        'numtraces':project.numtraces,
+        'archived':project.archived,
     }
     return ret
     
@@ -64,17 +88,28 @@ def get_public_project_short(project):
     }
     return ret
     
-def get_public_result(result):
+def get_public_result(result, lists=False):
     """Produce a public JSON representation of this result.
     
     Convert all private IDs into URIs, then put all attributes into a dict.
+    
+    The t-traces are only converted into lists if lists is set. Otherwise,
+    data gives the URI of each t-trace, where it can be downloaded as a 
+    .npy file.
     """
+    data = dict((k, v) for [k, v] in result.data.items() if not k.startswith('trace_'))
+    for [k, v] in result.traces().items():
+        if lists:
+            data[k] = v.tolist()
+        else:
+            data[k + '_uri'] = url_for('interface.get_result_trace', rid=result.id, name=k, _external=True)
     ret = {
         'uri':url_for('interface.get_result', rid=result.id, _external=True),
         'project_uri':url_for('interface.get_project', pid=result.pid, _external=True),
         'name':result.name,
         'status':result.status,
-        'data':result.data
+        'summary':result.get_summary(),
+        'data':data
     }
     return ret
     
@@ -86,9 +121,34 @@ def get_public_result_short(result):
         'project_uri':url_for('interface.get_project', pid=result.pid, _external=True),
         'name':result.name,
         'status':result.status,
+        'summary':result.summary,
     }
     return ret
     
+def valid_order(order):
+    """Check that a t-test order from the client is one we can compute."""
+    return isinstance(order, int) and not isinstance(order, bool) and \
+        1 <= order <= analysis.max_order
+        
+def valid_windows(windows):
+    """Check that sample windows from the client are a list of [start, stop]."""
+    if windows is None:
+        return True
+    if not isinstance(windows, list) or len(windows) == 0:
+        return False
+    for w in windows:
+        if not isinstance(w, list) or len(w) != 2:
+            return False
+        if not all(isinstance(i, int) and not isinstance(i, bool) for i in w):
+            return False
+        if not 0 <= w[0] < w[1]:
+            return False
+    return True
+    
+def valid_decimate(decimate):
+    """Check that a decimation factor from the client is a positive int."""
+    return isinstance(decimate, int) and not isinstance(decimate, bool) and decimate >= 1
+
 def get_cwproject_summary(fname):
     """Produce a JSON summary of a ChipWhisperer project.
     
@@ -142,11 +202,33 @@ def create_project():
     
     #Assume we are going into directory    
     
+    incremental = request.json.get('incremental', False)
+    if not isinstance(incremental, bool):
+        abort(400)
+        
+    order = request.json.get('order', 1)
+    if not valid_order(order):
+        abort(400)
+        
+    curve = request.json.get('curve', False)
+    if not isinstance(curve, bool):
+        abort(400)
+        
+    windows = request.json.get('windows', None)
+    decimate = request.json.get('decimate', 1)
+    if not valid_windows(windows) or not valid_decimate(decimate):
+        abort(400)
+    
     proj = Project(
         cwproject=cwproject,
         config=config,
         num_threads=request.json['num_threads'],
         title=request.json['title'],
+        incremental=incremental,
+        order=order,
+        curve=curve,
+        windows=windows,
+        decimate=decimate,
     )
     
     return jsonify({'project':get_public_project(proj)}), 201
@@ -167,12 +249,23 @@ def update_project(pid):
         {'name':'cwproject', 'type':basestring},
         {'name':'config', 'type':basestring},
         {'name':'title', 'type':basestring},
-        {'name':'running', 'type':bool}
+        {'name':'running', 'type':bool},
+        {'name':'incremental', 'type':bool},
+        {'name':'order', 'type':int},
+        {'name':'curve', 'type':bool},
+        {'name':'windows', 'type':(list, type(None))},
+        {'name':'decimate', 'type':int},
     ]
         
     for v in vars:
         if v['name'] in request.json and not isinstance(request.json[v['name']], v['type']):
             abort(400)
+    if 'order' in request.json and not valid_order(request.json['order']):
+        abort(400)
+    if 'windows' in request.json and not valid_windows(request.json['windows']):
+        abort(400)
+    if 'decimate' in request.json and not valid_decimate(request.json['decimate']):
+        abort(400)
 
     for v in vars:
         setattr(p, v['name'], request.json.get(v['name'], getattr(p, v['name'])))
@@ -203,7 +296,20 @@ def get_result(rid):
     try:
         res_list = shelve_db.get_results()
         r = res_list[rid]
-        return jsonify({'result': get_public_result(r)})
+        lists = request.args.get('traces') == 'list'
+        return jsonify({'result': get_public_result(r, lists)})
+    except KeyError:
+        abort(404)
+        
+@if_blueprint.route("/results/<int:rid>/traces/<name>", methods=["GET"])
+def get_result_trace(rid, name):
+    try:
+        res_list = shelve_db.get_results()
+        trace = res_list[rid].traces()[name]
+        buf = io.BytesIO()
+        np.save(buf, trace)
+        return send_file(io.BytesIO(buf.getvalue()), mimetype='application/octet-stream',
+                         as_attachment=True, attachment_filename='%d_%s.npy' % (rid, name))
     except KeyError:
         abort(404)
         
@@ -219,6 +325,82 @@ def get_cwproject(pid):
     except KeyError:
         abort(404)
         
+def parse_range(text):
+    """Turn a 'start:stop' range from the client into a slice.
+    
+    Either end can be left out. Returns None if the range isn't valid.
+    """
+    if text is None:
+        return slice(None)
+    parts = text.split(':')
+    if len(parts) != 2:
+        return None
+    try:
+        return slice(*[int(x) if x else None for x in parts])
+    except ValueError:
+        return None
+        
+def open_archive(pid):
+    """Open the archive of project pid, or abort if it doesn't have one."""
+    try:
+        if not shelve_db.get_projects()[pid].archived:
+            abort(404)
+        return result_store.load_archive(result_store.result_dir(analysis.result_path, pid))
+    except (KeyError, IOError):
+        abort(404)
+        
+@if_blueprint.route("/archives/<int:pid>", methods=["GET"])
+def get_archive(pid):
+    [index, archive] = open_archive(pid)
+    p = shelve_db.get_projects()[pid]
+    ret = {
+        'uri':url_for('interface.download_archive', pid=pid, _external=True),
+        'project_uri':url_for('interface.get_project', pid=pid, _external=True),
+        'keys':index['keys'],
+        'names':index['names'],
+        'shape':list(archive.shape),
+        'samples':p.samples,
+    }
+    return jsonify({'archive': ret})
+    
+@if_blueprint.route("/archives/<int:pid>/download", methods=["GET"])
+def download_archive(pid):
+    [index, archive] = open_archive(pid)
+    fname = result_store.archive_fname(result_store.result_dir(analysis.result_path, pid), index)
+    return send_file(os.path.abspath(fname), mimetype='application/octet-stream',
+                     as_attachment=True, attachment_filename='archive_%d.npy' % pid)
+    
+@if_blueprint.route("/archives/<int:pid>/traces/<key>", methods=["GET"])
+def get_archive_slice(pid, key):
+    [index, archive] = open_archive(pid)
+    if key not in index['keys']:
+        abort(404)
+    tests = parse_range(request.args.get('tests'))
+    points = parse_range(request.args.get('points'))
+    if tests is None or points is None:
+        abort(400)
+        
+    data = archive[index['keys'].index(key), tests, points]
+    ret = {
+        'names':index['names'][tests],
+        'points':range(*points.indices(archive.shape[2])),
+        'data':np.asarray(data, dtype=np.float64).tolist(),
+    }
+    return jsonify({'slice': ret})
+    
+@if_blueprint.route("/archives/<int:pid>/top/<key>", methods=["GET"])
+def get_archive_top(pid, key):
+    [index, archive] = open_archive(pid)
+    if key not in index['keys']:
+        abort(404)
+    k = request.args.get('k', 10, type=int)
+    if k < 1:
+        abort(400)
+        
+    top = result_store.top_k(archive[index['keys'].index(key)], k)
+    ret = [{'name':index['names'][test], 'point':point, 't':t} for [test, point, t] in top]
+    return jsonify({'top': ret})
+    
 @if_blueprint.route("/summaries/<int:pid>", methods=["GET"])
 def get_summary(pid):
     try:
@@ -226,18 +408,27 @@ def get_summary(pid):
         res_list = shelve_db.get_results()
         p = proj_list[pid]
         
+        if hasattr(res_list, 'get_summaries'):
+            # Read every summary in one query, without loading the results
+            records = res_list.get_summaries(p.results)
+        else:
+            records = {}
+        
         test_names = [''] * len(p.results)
         test_results = [0] * len(p.results)
-        for i in tqdm(range(len(p.results))):
+        summaries = [None] * len(p.results)
+        for i in range(len(p.results)):
             rid = p.results[i]
-            # TODO: this loop is pretty slow.
-            # This line is the cause - hopefully switching from Shelve to SQL
-            # will fix it. Until then we can get around 20 it/s
-            r_i = res_list[rid]
-            t_max = max(r_i.data['trace_c'])
-            test_names[i] = r_i.name
-            test_results[i] = t_max
-        ret = {'names': test_names, 't_values': test_results}
+            rec = records.get(rid)
+            if rec is None or (rec['summary'] is None and rec['status'] == 'finished'):
+                # Result finished before summaries were saved
+                r_i = res_list[rid]
+                rec = {'name': r_i.name, 'summary': r_i.get_summary()}
+            test_names[i] = rec['name']
+            summaries[i] = rec['summary']
+            if rec['summary'] is not None:
+                test_results[i] = rec['summary']['t_max']
+        ret = {'names': test_names, 't_values': test_results, 'summaries': summaries}
         return jsonify({'summary': ret})
     except KeyError:
-        abort(404)
\ No newline at end of file
+        abort(404)
@@ -0,0 +1,243 @@
+"""
+intermediates.py
+
+Columnar storage for the internal cipher states of every trace
+"""
+
+import binascii
+import numpy as np
+
+# Number of set bits in each byte value
+popcount_table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def int_to_bytes(x, nbytes):
+    """Convert a non-negative int into nbytes big-endian bytes.
+
+    This is the inverse of the models' flatten(): byte 0 is the most
+    significant byte of x.
+    """
+    return np.frombuffer(binascii.unhexlify('%0*x' % (2*nbytes, x)), dtype=np.uint8)
+
+def bytes_to_ints(states):
+    """Convert an (N x nbytes) uint8 array of states into a list of ints.
+    """
+    states = np.ascontiguousarray(states, dtype=np.uint8)
+    return [int(binascii.hexlify(row.tobytes()), 16) for row in states]
+
+def hamming_weight(states):
+    """Return the Hamming weight of each row of an (N x nbytes) uint8 array.
+
+    The weights are uint8 if they always fit (states of up to 31 bytes), 
+    otherwise uint16.
+    """
+    states = np.asarray(states, dtype=np.uint8)
+    dtype = np.uint8 if 8*states.shape[1] <= 255 else np.uint16
+    return popcount_table[states].sum(axis=1, dtype=dtype)
+
+def pad_bytes(states, nbytes):
+    """Widen an (N x k) uint8 array of states to nbytes, keeping their values.
+    """
+    states = np.asarray(states, dtype=np.uint8)
+    if states.shape[1] >= nbytes:
+        return states
+    ret = np.zeros((states.shape[0], nbytes), dtype=np.uint8)
+    ret[:, nbytes - states.shape[1]:] = states
+    return ret
+
+def shift_left(states, n):
+    """Shift each state left by n bits, like x << n on the flattened ints.
+
+    The states are widened by enough bytes that no bits are lost. Whole bytes
+    are moved as columns, then any remaining bits are carried between them.
+    """
+    states = np.asarray(states, dtype=np.uint8)
+    [q, r] = divmod(n, 8)
+    ret = pad_bytes(states, states.shape[1] + q + (1 if r else 0))
+    if q > 0:
+        ret[:, :-q] = ret[:, q:]
+        ret[:, -q:] = 0
+    if r > 0:
+        carry = ret[:, 1:] >> (8 - r)
+        ret = ret << r
+        ret[:, :-1] |= carry
+    return ret
+
+def shift_right(states, n):
+    """Shift each state right by n bits, like x >> n on the flattened ints.
+    """
+    states = np.asarray(states, dtype=np.uint8)
+    [q, r] = divmod(n, 8)
+    ret = np.zeros_like(states)
+    if q < states.shape[1]:
+        ret[:, q:] = states[:, :states.shape[1] - q]
+    if r > 0:
+        carry = ret[:, :-1] << (8 - r)
+        ret = ret >> r
+        ret[:, 1:] |= carry
+    return ret
+
+def equals(states, value):
+    """Return a bool for each state that is equal to the int value.
+    """
+    states = np.asarray(states, dtype=np.uint8)
+    if value < 0 or value >= 1 << (8*states.shape[1]):
+        return np.zeros(states.shape[0], dtype=bool)
+    return np.all(states == int_to_bytes(value, states.shape[1]), axis=1)
+
+class IntermediateStore(object):
+    """Internal states of every trace, one array per leakage point.
+
+    Each point is held as a contiguous (N x nbytes) uint8 array in the same
+    byte order as the models' flatten(), instead of one long per trace. The
+    config operations then work on whole columns at once.
+
+    Arguments:
+        numrows (int): number of traces
+        nbytes (int): number of bytes in each state
+    """
+    def __init__(self, numrows, nbytes=16):
+        self.numrows = numrows
+        self.nbytes = nbytes
+        self.columns = {}
+
+    @classmethod
+    def from_batch(cls, states):
+        """Make a store from the output of a model's cipher_batch().
+
+        Arguments:
+            states (dict of N x nbytes uint8 arrays): states by point name
+        """
+        shape = states.values()[0].shape
+        store = cls(shape[0], shape[1])
+        for name in states:
+            store.add(name, states[name])
+        return store
+
+    @classmethod
+    def from_rows(cls, rows, numrows, nbytes=16):
+        """Make a store from per-trace dicts of flattened states.
+
+        Arguments:
+            rows (iterable of dicts): output of a model's cipher() for each
+                trace, in order. This can be a generator, so only the trace
+                being stored has to be kept as ints.
+            numrows (int): number of traces in rows
+        """
+        store = cls(numrows, nbytes)
+        for [i, row] in enumerate(rows):
+            store.set_row(i, row)
+        return store
+
+    def add(self, name, states):
+        """Store the states of every trace at one point.
+        """
+        states = np.ascontiguousarray(states, dtype=np.uint8)
+        if states.shape != (self.numrows, self.nbytes):
+            raise ValueError("Expected %d x %d states for %s, got %s" % (self.numrows, self.nbytes, name, states.shape))
+        self.columns[name] = states
+
+    def set_row(self, i, row):
+        """Store every point of trace i from a dict of flattened states.
+        """
+        for name in row:
+            if name not in self.columns:
+                self.columns[name] = np.zeros((self.numrows, self.nbytes), dtype=np.uint8)
+            self.columns[name][i] = int_to_bytes(row[name], self.nbytes)
+
+    def names(self):
+        return self.columns.keys()
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def masked(self, name, mask):
+        """Return the states at one point ANDed with an int mask.
+
+        Mask bits above the width of the states are ignored, as they are 
+        when the mask is ANDed with a flattened state.
+        """
+        mask &= (1 << 8*self.nbytes) - 1
+        return self.columns[name] & int_to_bytes(mask, self.nbytes)
+
+    def memory(self):
+        """Return the number of bytes used by the stored states.
+        """
+        return sum(c.nbytes for c in self.columns.values())
+
+def test_round_trip():
+    rows = [{'a':0x0102, 'b':(1 << 127) | 5}, {'a':0, 'b':(1 << 128) - 1}]
+    store = IntermediateStore.from_rows(iter(rows), 2)
+    if sorted(store.names()) != ['a', 'b']:
+        raise ValueError("Store has the wrong points")
+    for name in ['a', 'b']:
+        if bytes_to_ints(store[name]) != [r[name] for r in rows]:
+            raise ValueError("Stored states differ from the flattened ones")
+    if store['a'][0, -2:].tolist() != [1, 2]:
+        raise ValueError("States aren't stored big-endian")
+
+    batch = IntermediateStore.from_batch({'a':store['a']})
+    if not np.array_equal(batch['a'], store['a']):
+        raise ValueError("Batch states differ from the flattened ones")
+    try:
+        batch.add('c', np.zeros((3, 16)))
+        raise AssertionError("Added states with the wrong shape")
+    except ValueError:
+        pass
+
+    print "Round Trip: [PASS]"
+
+def test_masked():
+    rows = [{'a':(0xff << 120) | 0xf0f}, {'a':(0x81 << 120) | 0x3}]
+    store = IntermediateStore.from_rows(rows, 2)
+    mask = (0x80 << 120) | 0xff
+    if bytes_to_ints(store.masked('a', mask)) != [r['a'] & mask for r in rows]:
+        raise ValueError("Masked states differ from the flattened ones")
+    if bytes_to_ints(store['a']) != [r['a'] for r in rows]:
+        raise ValueError("Masking changed the stored states")
+
+    # Masks wider than the states, like the 256-bit ones in xor256_dpa.cfg
+    wide = (0xff << 248) | (1 << 200) | 0x0f
+    if bytes_to_ints(store.masked('a', wide)) != [r['a'] & wide for r in rows]:
+        raise ValueError("Wide masks aren't truncated to the states")
+
+    print "Masked: [PASS]"
+
+def test_hamming_weight():
+    x = [0, 1, (1 << 128) - 1, 0x8000000000000000000000000000000f, 12345678901234567890]
+    hw = hamming_weight(np.array([int_to_bytes(i, 16) for i in x]))
+    if hw.dtype != np.uint8 or hw.tolist() != [bin(i).count("1") for i in x]:
+        raise ValueError("Hamming weights differ from bin().count()")
+    if hamming_weight(np.full((1, 40), 0xff, dtype=np.uint8)).tolist() != [320]:
+        raise ValueError("Hamming weights of long states overflow")
+
+    print "Hamming Weight: [PASS]"
+
+def test_operations():
+    x = [0, 1, (1 << 128) - 1, 0x8000000000000000000000000000000f, 12345678901234567890]
+    states = np.array([int_to_bytes(i, 16) for i in x])
+    for n in [0, 1, 7, 8, 9, 64, 100, 127, 128, 135]:
+        if bytes_to_ints(shift_left(states, n)) != [i << n for i in x]:
+            raise ValueError("Left shift by %d differs from the ints" % n)
+        if bytes_to_ints(shift_right(states, n)) != [i >> n for i in x]:
+            raise ValueError("Right shift by %d differs from the ints" % n)
+    for v in [0, 1, x[3], -1, 1 << 128]:
+        if equals(states, v).tolist() != [i == v for i in x]:
+            raise ValueError("Equality with %d differs from the ints" % v)
+    if bytes_to_ints(pad_bytes(states, 20)) != x:
+        raise ValueError("Padding changed the states")
+
+    print "Operations: [PASS]"
+
+if __name__ == "__main__":
+    tests = [
+        test_round_trip,
+        test_masked,
+        test_hamming_weight,
+        test_operations,
+    ]
+
+    for t in tests:
+        t()
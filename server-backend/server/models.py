@@ -1,13 +1,74 @@
-try:
-    from chipwhisperer.analyzer.attacks.models.aes.funcs import subbytes, mixcolumns, shiftrows, inv_subbytes, inv_mixcolumns, inv_shiftrows
-    from chipwhisperer.analyzer.attacks.models.aes.key_schedule import keyScheduleRounds
-except ImportError:
-    print "Note: can't find ChipWhisperer Analyzer functions for AES"
-    print "Importing local copy..."
-    from aes_helper import *
-    
-
+import binascii
+import collections
+import re
+import numpy as np
+import aes_helper
+from aes_helper import subbytes, mixcolumns, shiftrows, inv_subbytes, inv_mixcolumns, inv_shiftrows
+from aes_helper import keyScheduleRounds
+from aes_helper import subbytes_batch, shiftrows_batch, mixcolumns_batch
+from aes_helper import inv_subbytes_batch, inv_shiftrows_batch, inv_mixcolumns_batch
 
+def expand_key(key, Nr):
+    """Return the round keys 0 to Nr of an AES key as lists of ints.
+    """
+    key = [int(k) for k in key]
+    if len(key) != 16:
+        return [keyScheduleRounds(key, 0, r) for r in range(Nr+1)]
+        
+    # Step from each round key to the next instead of starting over
+    ks = [key]
+    for r in range(1, Nr+1):
+        ks.append(keyScheduleRounds(ks[-1], r-1, r))
+    return ks
+    
+class KeyScheduleCache(object):
+    """Expanded key schedules, memoized by the key bytes.
+    
+    Fixed-key captures only ever expand their key once. The cache is a 
+    bounded LRU, so random-key captures just fall back to expanding every 
+    key without using up memory.
+    """
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.schedules = collections.OrderedDict()
+        
+    def get(self, key, Nr):
+        """Return expand_key(key, Nr), from the cache if possible.
+        """
+        k = (bytes(bytearray([int(b) for b in key])), Nr)
+        ks = self.schedules.pop(k, None)
+        if ks is None:
+            ks = expand_key(key, Nr)
+            if len(self.schedules) >= self.max_size:
+                self.schedules.popitem(last=False)
+        self.schedules[k] = ks
+        return ks
+        
+# Shared by every model in this process
+key_schedules = KeyScheduleCache()
+    
+def key_schedule_batch(key, Nr):
+    """Expand an AES key for every trace.
+    
+    When every trace uses the same key (the usual case), the schedule is only
+    expanded once and shared between the rows. Otherwise every distinct key 
+    is expanded at once.
+    
+    Arguments:
+        key (N x nbytes array of uint8): one key per trace
+        Nr (int): number of rounds
+    
+    Returns:
+        (Nr+1 x N x 16 array of uint8): round keys 0 to Nr for each trace. 
+            This may be a read-only view.
+    """
+    key = np.asarray(key, dtype=np.uint8)
+    if len(key) > 0 and np.all(key == key[0]):
+        ks = np.array(key_schedules.get(key[0], Nr), dtype=np.uint8)
+        return np.broadcast_to(ks[:, None, :], (Nr+1, len(key), 16))
+        
+    [uniq, inverse] = np.unique(key, axis=0, return_inverse=True)
+    return aes_helper.key_expansion_batch(uniq, Nr)[:, inverse]
     
 class Leakage_Base(object):
     name = 'Leakage model base class'
@@ -15,8 +76,44 @@ class Leakage_Base(object):
     # TODO: autogenerate (or automatically validate) these lists
     leakage_points = []
     
-    def cipher(self):
+    def cipher(self, pt, key, points=None):
         raise NotImplementedError()
+        
+    # Models can also define cipher_batch(pt, key, points=None), which takes 
+    # an (N x nbytes) uint8 array of each and returns every leakage point as 
+    # an (N x 16) uint8 array. Setup uses it instead of calling cipher() for 
+    # every trace.
+    #
+    # Both only have to return the leakage points named in points, and can 
+    # stop as soon as they have all of them (see last_round()).
+    
+    def saver(self, ret, points, flatten=None):
+        """Return a function save(name, state) that stores state in ret.
+        
+        States of points that weren't asked for are dropped without being 
+        flattened. If flatten is None, states are stored as they are.
+        """
+        def save(name, state):
+            if points is None or name in points:
+                ret[name] = state if flatten is None else flatten(state)
+        return save
+        
+    def last_round(self, points, Nr):
+        """Return the last round that has to be run to find all of points.
+        
+        Points are named 'Round r: ...'; the plaintext and key are found 
+        before round 1, and anything else (the ciphertext) needs every round.
+        """
+        if points is None:
+            return Nr
+        last = 0
+        for name in points:
+            m = re.match(r'Round (\d+):', name)
+            if m:
+                last = max(last, int(m.group(1)))
+            elif name != 'Plaintext' and not name.startswith('Key'):
+                last = Nr
+        return last
     
     
     
@@ -90,50 +187,103 @@ class AES128_Leakage(Leakage_Base):
             ret = ret & ((1 << 128) - 1)
         return ret
         
-    def cipher(self, pt, key):
-        # Note: we assume fixed key here for huge speedup
-        # TODO: make this an option
-        #if self.ks is None:
-        self.ks = [keyScheduleRounds(key, 0, r) for r in range(11)]
+    def cipher(self, pt, key, points=None):
+        self.ks = key_schedules.get(key, 10)
     
         ret = {}
+        save = self.saver(ret, points, self.flatten)
         
         Nr = 10
+        last = self.last_round(points, Nr)
         state = pt
-        ret['Plaintext'] = self.flatten(state[:])
+        save('Plaintext', state)
         
-        ret['Key'] = self.flatten(self.ks[0])
+        save('Key', self.ks[0])
         
         state = [state[i] ^ self.ks[0][i] for i in range(16)]
-        ret['Round 0: AddRoundKey Output'] = self.flatten(state[:])
+        save('Round 0: AddRoundKey Output', state)
         
         for r in range(1, Nr):
+            if r > last:
+                return ret
+                
             state = subbytes(state)
-            ret['Round ' + str(r) + ': SubBytes Output'] = self.flatten(state[:])
+            save('Round ' + str(r) + ': SubBytes Output', state)
             
             state = shiftrows(state)
-            ret['Round ' + str(r) + ': ShiftRows Output'] = self.flatten(state[:])
+            save('Round ' + str(r) + ': ShiftRows Output', state)
             
             state = mixcolumns(state)
-            ret['Round ' + str(r) + ': MixColumns Output'] = self.flatten(state[:])
+            save('Round ' + str(r) + ': MixColumns Output', state)
         
-            ret['Round ' + str(r) + ': RoundKey'] = self.flatten(self.ks[r])
+            save('Round ' + str(r) + ': RoundKey', self.ks[r])
         
             state = [state[i] ^ self.ks[r][i] for i in range(16)]
-            ret['Round ' + str(r) + ': AddRoundKey Output'] = self.flatten(state[:])
-        
+            save('Round ' + str(r) + ': AddRoundKey Output', state)
         
+        if Nr > last:
+            return ret
         
         state = subbytes(state)
-        ret['Round 10: SubBytes Output'] = self.flatten(state[:])
+        save('Round 10: SubBytes Output', state)
         
         state = shiftrows(state)
-        ret['Round 10: ShiftRows Output'] = self.flatten(state[:])
+        save('Round 10: ShiftRows Output', state)
         
-        ret['Round 10: RoundKey'] = self.flatten(self.ks[Nr])
+        save('Round 10: RoundKey', self.ks[Nr])
         
         state = [state[i] ^ self.ks[Nr][i] for i in range(16)]
-        ret['Ciphertext'] = self.flatten(state[:])
+        save('Ciphertext', state)
+        
+        return ret
+        
+    def cipher_batch(self, pt, key, points=None):
+        ks = key_schedule_batch(key, 10)
+        
+        ret = {}
+        save = self.saver(ret, points)
+        
+        Nr = 10
+        last = self.last_round(points, Nr)
+        state = np.asarray(pt, dtype=np.uint8)
+        save('Plaintext', state)
+        
+        save('Key', ks[0])
+        
+        state = state ^ ks[0]
+        save('Round 0: AddRoundKey Output', state)
+        
+        for r in range(1, Nr):
+            if r > last:
+                return ret
+                
+            state = subbytes_batch(state)
+            save('Round ' + str(r) + ': SubBytes Output', state)
+            
+            state = shiftrows_batch(state)
+            save('Round ' + str(r) + ': ShiftRows Output', state)
+            
+            state = mixcolumns_batch(state)
+            save('Round ' + str(r) + ': MixColumns Output', state)
+        
+            save('Round ' + str(r) + ': RoundKey', ks[r])
+        
+            state = state ^ ks[r]
+            save('Round ' + str(r) + ': AddRoundKey Output', state)
+        
+        if Nr > last:
+            return ret
+        
+        state = subbytes_batch(state)
+        save('Round 10: SubBytes Output', state)
+        
+        state = shiftrows_batch(state)
+        save('Round 10: ShiftRows Output', state)
+        
+        save('Round 10: RoundKey', ks[Nr])
+        
+        state = state ^ ks[Nr]
+        save('Ciphertext', state)
         
         return ret
         
@@ -207,48 +357,103 @@ class AES128_SRSBOX_Leakage(Leakage_Base):
             ret = ret & ((1 << 128) - 1)
         return ret
         
-    def cipher(self, pt, key):
-        # Note: we assume fixed key here for huge speedup
-        # TODO: make this an option
-        #if self.ks is None:
-        self.ks = [keyScheduleRounds(key, 0, r) for r in range(11)]
+    def cipher(self, pt, key, points=None):
+        self.ks = key_schedules.get(key, 10)
     
         ret = {}
+        save = self.saver(ret, points, self.flatten)
         
         Nr = 10
+        last = self.last_round(points, Nr)
         state = pt
-        ret['Plaintext'] = self.flatten(state[:])
+        save('Plaintext', state)
         
-        ret['Key'] = self.flatten(self.ks[0])
+        save('Key', self.ks[0])
         
         state = [state[i] ^ self.ks[0][i] for i in range(16)]
-        ret['Round 0: AddRoundKey Output'] = self.flatten(state[:])
+        save('Round 0: AddRoundKey Output', state)
+        
+        if last == 0:
+            return ret
         
         state = shiftrows(state)
-        ret['Round 1: ShiftRows Output'] = self.flatten(state[:])
+        save('Round 1: ShiftRows Output', state)
         
         for r in range(1, Nr+1):
+            if r > last:
+                return ret
+                
             state = subbytes(state)
-            ret['Round ' + str(r) + ': SubBytes Output'] = self.flatten(state[:])
+            save('Round ' + str(r) + ': SubBytes Output', state)
             
             if r == Nr:
                 break
                         
             state = mixcolumns(state)
-            ret['Round ' + str(r) + ': MixColumns Output'] = self.flatten(state[:])
+            save('Round ' + str(r) + ': MixColumns Output', state)
         
-            ret['Round ' + str(r) + ': RoundKey'] = self.flatten(self.ks[r])
+            save('Round ' + str(r) + ': RoundKey', self.ks[r])
         
             state = [state[i] ^ self.ks[r][i] for i in range(16)]
-            ret['Round ' + str(r) + ': AddRoundKey Output'] = self.flatten(state[:])
+            save('Round ' + str(r) + ': AddRoundKey Output', state)
             
             state = shiftrows(state)
-            ret['Round ' + str(r+1) + ': ShiftRows Output'] = self.flatten(state[:])
+            save('Round ' + str(r+1) + ': ShiftRows Output', state)
                
-        ret['Round 10: RoundKey'] = self.flatten(self.ks[Nr])
+        save('Round 10: RoundKey', self.ks[Nr])
         
         state = [state[i] ^ self.ks[Nr][i] for i in range(16)]
-        ret['Ciphertext'] = self.flatten(state[:])
+        save('Ciphertext', state)
+        
+        return ret
+        
+    def cipher_batch(self, pt, key, points=None):
+        ks = key_schedule_batch(key, 10)
+        
+        ret = {}
+        save = self.saver(ret, points)
+        
+        Nr = 10
+        last = self.last_round(points, Nr)
+        state = np.asarray(pt, dtype=np.uint8)
+        save('Plaintext', state)
+        
+        save('Key', ks[0])
+        
+        state = state ^ ks[0]
+        save('Round 0: AddRoundKey Output', state)
+        
+        if last == 0:
+            return ret
+        
+        state = shiftrows_batch(state)
+        save('Round 1: ShiftRows Output', state)
+        
+        for r in range(1, Nr+1):
+            if r > last:
+                return ret
+                
+            state = subbytes_batch(state)
+            save('Round ' + str(r) + ': SubBytes Output', state)
+            
+            if r == Nr:
+                break
+                        
+            state = mixcolumns_batch(state)
+            save('Round ' + str(r) + ': MixColumns Output', state)
+        
+            save('Round ' + str(r) + ': RoundKey', ks[r])
+        
+            state = state ^ ks[r]
+            save('Round ' + str(r) + ': AddRoundKey Output', state)
+            
+            state = shiftrows_batch(state)
+            save('Round ' + str(r+1) + ': ShiftRows Output', state)
+               
+        save('Round 10: RoundKey', ks[Nr])
+        
+        state = state ^ ks[Nr]
+        save('Ciphertext', state)
         
         return ret
         
@@ -319,50 +524,103 @@ class AES256_Leakage(Leakage_Base):
         self.ks = None
         
     def flatten(self, state):
-        ret = 0
+        ret = 0L
         for i in range(16):
             ret <<= 8
-            ret |= state[i]
+            ret |= int(state[i])
         return ret
         
-    def cipher(self, pt, key):
+    def cipher(self, pt, key, points=None):
         Nr = 14
-        if self.ks is None:
-            self.ks = [keyScheduleRounds(key, 0, r) for r in range(Nr+1)]
+        self.ks = key_schedules.get(key, Nr)
     
         ret = {}
+        save = self.saver(ret, points, self.flatten)
         
+        last = self.last_round(points, Nr)
         state = pt
-        ret['Plaintext'] = self.flatten(state[:])
+        save('Plaintext', state)
         
-        ret['Key (bytes 0-15)']  = self.flatten(self.ks[0])
-        ret['Key (bytes 16-31)'] = self.flatten(self.ks[1])
+        save('Key (bytes 0-15)', self.ks[0])
+        save('Key (bytes 16-31)', self.ks[1])
         
         state = [state[i] ^ self.ks[0][i] for i in range(16)]
-        ret['Round 0: AddRoundKey Output'] = self.flatten(state[:])
+        save('Round 0: AddRoundKey Output', state)
         
         for r in range(1, Nr):
+            if r > last:
+                return ret
+                
             state = subbytes(state)
-            ret['Round ' + str(r) + ': SubBytes Output'] = self.flatten(state[:])
+            save('Round ' + str(r) + ': SubBytes Output', state)
             
             state = shiftrows(state)
-            ret['Round ' + str(r) + ': ShiftRows Output'] = self.flatten(state[:])
+            save('Round ' + str(r) + ': ShiftRows Output', state)
             
             state = mixcolumns(state)
-            ret['Round ' + str(r) + ': MixColumns Output'] = self.flatten(state[:])
+            save('Round ' + str(r) + ': MixColumns Output', state)
             
             state = [state[i] ^ self.ks[r][i] for i in range(16)]
-            ret['Round ' + str(r) + ': AddRoundKey Output'] = self.flatten(state[:])
+            save('Round ' + str(r) + ': AddRoundKey Output', state)
         
+        if Nr > last:
+            return ret
         
         state = subbytes(state)
-        ret['Round 14: SubBytes Output'] = self.flatten(state[:])
+        save('Round 14: SubBytes Output', state)
         
         state = shiftrows(state)
-        ret['Round 14: ShiftRows Output'] = self.flatten(state[:])
+        save('Round 14: ShiftRows Output', state)
         
         state = [state[i] ^ self.ks[Nr][i] for i in range(16)]
-        ret['Ciphertext'] = self.flatten(state[:])
+        save('Ciphertext', state)
+        
+        return ret
+        
+    def cipher_batch(self, pt, key, points=None):
+        Nr = 14
+        ks = key_schedule_batch(key, Nr)
+    
+        ret = {}
+        save = self.saver(ret, points)
+        
+        last = self.last_round(points, Nr)
+        state = np.asarray(pt, dtype=np.uint8)
+        save('Plaintext', state)
+        
+        save('Key (bytes 0-15)', ks[0])
+        save('Key (bytes 16-31)', ks[1])
+        
+        state = state ^ ks[0]
+        save('Round 0: AddRoundKey Output', state)
+        
+        for r in range(1, Nr):
+            if r > last:
+                return ret
+                
+            state = subbytes_batch(state)
+            save('Round ' + str(r) + ': SubBytes Output', state)
+            
+            state = shiftrows_batch(state)
+            save('Round ' + str(r) + ': ShiftRows Output', state)
+            
+            state = mixcolumns_batch(state)
+            save('Round ' + str(r) + ': MixColumns Output', state)
+            
+            state = state ^ ks[r]
+            save('Round ' + str(r) + ': AddRoundKey Output', state)
+        
+        if Nr > last:
+            return ret
+        
+        state = subbytes_batch(state)
+        save('Round 14: SubBytes Output', state)
+        
+        state = shiftrows_batch(state)
+        save('Round 14: ShiftRows Output', state)
+        
+        state = state ^ ks[Nr]
+        save('Ciphertext', state)
         
         return ret
         
@@ -452,48 +710,124 @@ class AES256_Decryption_Leakage(Leakage_Base):
             x[i+3] = (xrev >>  0) & 0xFF
         return x
         
-    def cipher(self, input, key):
+    # Each byte with its bits reversed, and the order of the bytes in a 
+    # reversed 32-bit word
+    bitrev_table = np.array([int("{:08b}".format(i)[::-1], 2) for i in range(256)], dtype=np.uint8)
+    word_reverse_index = np.array([4*(i/4) + 3 - i%4 for i in range(16)])
+    
+    def reverse_bits_batch(self, x):
+        """Reverse the bits of each 32-bit word in an (N x 16) uint8 array.
+        """
+        return self.bitrev_table[x[:, self.word_reverse_index]]
+        
+    def first_round(self, points, Nr):
+        """Return the earliest round that has to be reached to find all of
+        points, working backwards from the ciphertext.
+        """
+        if points is None:
+            return 0
+        first = Nr
+        for name in points:
+            m = re.match(r'Round (\d+):', name)
+            if m:
+                first = min(first, int(m.group(1)))
+            elif name == 'Plaintext':
+                first = 0
+        return first
+        
+    def cipher(self, input, key, points=None):
         Nr = 14
-        #if self.ks is None:
-        self.ks = [keyScheduleRounds(key, 0, r) for r in range(Nr+1)]
+        self.ks = key_schedules.get(key, Nr)
     
         ret = {}
+        save = self.saver(ret, points, self.flatten)
         
+        first = self.first_round(points, Nr)
         state = input
-        ret['Ciphertext (Unflipped)'] = self.flatten(state)
+        save('Ciphertext (Unflipped)', state)
         
         
-        ret['Key (bytes 0-15)']  = self.flatten(self.ks[0])
-        ret['Key (bytes 16-31)'] = self.flatten(self.ks[1])
+        save('Key (bytes 0-15)', self.ks[0])
+        save('Key (bytes 16-31)', self.ks[1])
         
         state = self.reverse_bits(input)
-        ret['Ciphertext (Flipped)'] = self.flatten(state)
+        save('Ciphertext (Flipped)', state)
         state = [state[i] ^ self.ks[Nr][i] for i in range(16)]
         
-        ret['Round 14: ShiftRows Output'] = self.flatten(state[:])
+        save('Round 14: ShiftRows Output', state)
         state = inv_shiftrows(state)
         
-        ret['Round 14: SubBytes Output'] = self.flatten(state[:])
+        save('Round 14: SubBytes Output', state)
         state = inv_subbytes(state)
      
         for r in reversed(range(1, Nr)):
-            ret['Round ' + str(r) + ': AddRoundKey Output'] = self.flatten(state[:])
+            if r < first:
+                return ret
+                
+            save('Round ' + str(r) + ': AddRoundKey Output', state)
             state = [state[i] ^ self.ks[r][i] for i in range(16)]
             
-            ret['Round ' + str(r) + ': MixColumns Output'] = self.flatten(state[:])
+            save('Round ' + str(r) + ': MixColumns Output', state)
             state = inv_mixcolumns(state)
             
-            ret['Round ' + str(r) + ': ShiftRows Output'] = self.flatten(state[:])
+            save('Round ' + str(r) + ': ShiftRows Output', state)
             state = inv_shiftrows(state)
             
-            ret['Round ' + str(r) + ': SubBytes Output'] = self.flatten(state[:])
+            save('Round ' + str(r) + ': SubBytes Output', state)
             state = inv_subbytes(state)
         
-        ret['Round 0: AddRoundKey Output'] = self.flatten(state[:])
+        save('Round 0: AddRoundKey Output', state)
         state = [state[i] ^ self.ks[0][i] for i in range(16)]
         
         
-        ret['Plaintext'] = self.flatten(state[:])
+        save('Plaintext', state)
+        
+        return ret
+        
+    def cipher_batch(self, input, key, points=None):
+        Nr = 14
+        ks = key_schedule_batch(key, Nr)
+    
+        ret = {}
+        save = self.saver(ret, points)
+        
+        first = self.first_round(points, Nr)
+        state = np.asarray(input, dtype=np.uint8)
+        save('Ciphertext (Unflipped)', state)
+        
+        save('Key (bytes 0-15)', ks[0])
+        save('Key (bytes 16-31)', ks[1])
+        
+        state = self.reverse_bits_batch(state)
+        save('Ciphertext (Flipped)', state)
+        state = state ^ ks[Nr]
+        
+        save('Round 14: ShiftRows Output', state)
+        state = inv_shiftrows_batch(state)
+        
+        save('Round 14: SubBytes Output', state)
+        state = inv_subbytes_batch(state)
+     
+        for r in reversed(range(1, Nr)):
+            if r < first:
+                return ret
+                
+            save('Round ' + str(r) + ': AddRoundKey Output', state)
+            state = state ^ ks[r]
+            
+            save('Round ' + str(r) + ': MixColumns Output', state)
+            state = inv_mixcolumns_batch(state)
+            
+            save('Round ' + str(r) + ': ShiftRows Output', state)
+            state = inv_shiftrows_batch(state)
+            
+            save('Round ' + str(r) + ': SubBytes Output', state)
+            state = inv_subbytes_batch(state)
+        
+        save('Round 0: AddRoundKey Output', state)
+        state = state ^ ks[0]
+        
+        save('Plaintext', state)
         
         return ret
         
@@ -515,14 +849,28 @@ class XOR256_Leakage(Leakage_Base):
             ret = ret & ((1 << 128) - 1)
         return ret
         
-    def cipher(self, input, key):
+    def cipher(self, input, key, points=None):
         ret = {}
-        ret['Plaintext'] = self.flatten(input)
-        ret['Key'] = self.flatten(key)
+        save = self.saver(ret, points, self.flatten)
+        save('Plaintext', input)
+        save('Key', key)
         
         for i in range(32):
             input[i] ^= key[i]
-        ret['Ciphertext'] = self.flatten(input)
+        save('Ciphertext', input)
+        
+        return ret
+        
+    def cipher_batch(self, input, key, points=None):
+        ret = {}
+        save = self.saver(ret, points)
+        
+        # flatten() only keeps the last 16 bytes
+        input = np.asarray(input, dtype=np.uint8)
+        key = np.asarray(key, dtype=np.uint8)
+        save('Plaintext', input[:, 16:])
+        save('Key', key[:, 16:])
+        save('Ciphertext', (input ^ key)[:, 16:])
         
         return ret
         
@@ -544,14 +892,27 @@ class XOR128_Leakage(Leakage_Base):
             ret = ret & ((1 << 128) - 1)
         return ret
         
-    def cipher(self, input, key):
+    def cipher(self, input, key, points=None):
         ret = {}
-        ret['Plaintext'] = self.flatten(input)
-        ret['Key'] = self.flatten(key)
+        save = self.saver(ret, points, self.flatten)
+        save('Plaintext', input)
+        save('Key', key)
         
         for i in range(16):
             input[i] ^= key[i]
-        ret['Ciphertext'] = self.flatten(input)
+        save('Ciphertext', input)
+        
+        return ret
+        
+    def cipher_batch(self, input, key, points=None):
+        ret = {}
+        save = self.saver(ret, points)
+        
+        input = np.asarray(input, dtype=np.uint8)
+        key = np.asarray(key, dtype=np.uint8)
+        save('Plaintext', input)
+        save('Key', key)
+        save('Ciphertext', (input ^ key))
         
         return ret
         
@@ -562,4 +923,138 @@ models = [
     AES256_Decryption_Leakage,
     XOR128_Leakage,
     XOR256_Leakage,
-    ]
\ No newline at end of file
+    ]
+def random_inputs(n, nbytes, fixed_key):
+    """Make random texts and keys for n traces, with one key for every trace 
+    if fixed_key is set.
+    """
+    pt = np.random.randint(0, 256, (n, nbytes)).astype(np.uint8)
+    key = np.random.randint(0, 256, (1 if fixed_key else n, nbytes)).astype(np.uint8)
+    return pt, np.repeat(key, n / len(key), axis=0)
+    
+def batch_mismatches(model, pt, key):
+    """Return the leakage points where model.cipher_batch() and 
+    model.cipher() disagree on any trace.
+    """
+    import intermediates
+    batch = dict((name, intermediates.bytes_to_ints(states)) for [name, states] in model.cipher_batch(pt, key).items())
+    bad = set()
+    for i in range(len(pt)):
+        # cipher() can change its inputs in place, so it gets copies
+        row = model.cipher([int(b) for b in pt[i]], [int(b) for b in key[i]])
+        bad |= set(row) ^ set(batch)
+        bad |= set(name for name in row if name in batch and batch[name][i] != row[name])
+    return sorted(bad)
+    
+def hex_rows(text):
+    """Convert a hex string into a 1-row uint8 array.
+    """
+    return np.frombuffer(binascii.unhexlify(text), dtype=np.uint8)[None, :]
+    
+def test_aes128_batch():
+    model = AES128_Leakage()
+    for fixed_key in [True, False]:
+        [pt, key] = random_inputs(50, 16, fixed_key)
+        bad = batch_mismatches(model, pt, key)
+        if bad:
+            raise ValueError("Batch AES-128 differs at %s (fixed key: %s)" % (bad, fixed_key))
+        
+    # Points that stop after an early round
+    points = set(['Round 2: SubBytes Output'])
+    if model.cipher_batch(pt, key, points).keys() != list(points):
+        raise ValueError("Batch AES-128 returned the wrong points")
+        
+    print "AES-128 Batch: [PASS]"
+    
+def test_aes128_known_answer():
+    # FIPS-197 appendices B and C.1
+    vectors = [
+        ['2b7e151628aed2a6abf7158809cf4f3c', '3243f6a8885a308d313198a2e0370734', '3925841d02dc09fbdc118597196a0b32'],
+        ['000102030405060708090a0b0c0d0e0f', '00112233445566778899aabbccddeeff', '69c4e0d86a7b0430d8cdb78070b4c55a'],
+    ]
+    model = AES128_Leakage()
+    for [key, pt, ct] in vectors:
+        out = model.cipher_batch(hex_rows(pt), hex_rows(key), ['Ciphertext'])['Ciphertext']
+        if binascii.hexlify(out.tobytes()) != ct:
+            raise ValueError("AES-128 of %s under %s should be %s" % (pt, key, ct))
+        
+    print "AES-128 Known Answer: [PASS]"
+    
+def test_batch_models():
+    # Key length of each of the other models; the text is 16 bytes for AES
+    for [model, nbytes] in [[AES128_SRSBOX_Leakage(), 16], [AES256_Leakage(), 32], [XOR128_Leakage(), 16], [XOR256_Leakage(), 32]]:
+        for fixed_key in [True, False]:
+            [pt, key] = random_inputs(50, nbytes, fixed_key)
+            if model.name.startswith('AES'):
+                pt = pt[:, :16]
+            bad = batch_mismatches(model, pt, key)
+            if bad:
+                raise ValueError("Batch %s differs at %s (fixed key: %s)" % (model.name, bad, fixed_key))
+                
+    # The SRSBOX model reorders the rounds but computes the same cipher
+    # (FIPS-197 appendix C.1)
+    out = AES128_SRSBOX_Leakage().cipher_batch(hex_rows('00112233445566778899aabbccddeeff'), 
+        hex_rows('000102030405060708090a0b0c0d0e0f'), ['Ciphertext'])['Ciphertext']
+    if binascii.hexlify(out.tobytes()) != '69c4e0d86a7b0430d8cdb78070b4c55a':
+        raise ValueError("Batch %s gives the wrong ciphertext" % AES128_SRSBOX_Leakage.name)
+        
+    print "Batch Models: [PASS]"
+    
+def test_aes256_known_answer():
+    # FIPS-197 appendix C.3
+    key = '000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f'
+    pt = '00112233445566778899aabbccddeeff'
+    ct = '8ea2b7ca516745bfeafc49904b496089'
+    out = AES256_Leakage().cipher_batch(hex_rows(pt), hex_rows(key), ['Ciphertext'])['Ciphertext']
+    if binascii.hexlify(out.tobytes()) != ct:
+        raise ValueError("AES-256 of %s under %s should be %s" % (pt, key, ct))
+        
+    print "AES-256 Known Answer: [PASS]"
+    
+def test_aes256_decryption_batch():
+    model = AES256_Decryption_Leakage()
+    for fixed_key in [True, False]:
+        [ct, key] = random_inputs(50, 32, fixed_key)
+        bad = batch_mismatches(model, ct[:, :16], key)
+        if bad:
+            raise ValueError("Batch AES-256 decryption differs at %s (fixed key: %s)" % (bad, fixed_key))
+    
+    flipped = model.reverse_bits_batch(ct[:, :16])
+    if [list(r) for r in flipped] != [model.reverse_bits([int(b) for b in r]) for r in ct[:, :16]]:
+        raise ValueError("Batch bit reversal differs from reverse_bits()")
+        
+    print "AES-256 Decryption Batch: [PASS]"
+    
+def test_aes256_round_trip():
+    [pt, key] = random_inputs(50, 32, False)
+    pt = pt[:, :16]
+    enc = AES256_Leakage().cipher_batch(pt, key)
+    
+    # The decryption model takes the ciphertext with its bits flipped
+    dec_model = AES256_Decryption_Leakage()
+    dec = dec_model.cipher_batch(dec_model.reverse_bits_batch(enc['Ciphertext']), key)
+    if not np.array_equal(dec['Plaintext'], pt):
+        raise ValueError("Decrypting the ciphertext didn't give the plaintext")
+        
+    # Every state is the same going either way
+    common = (set(enc) & set(dec)) - set(['Plaintext'])
+    if len(common) < 50:
+        raise ValueError("Expected the models to share most points; got %d" % len(common))
+    bad = sorted(name for name in common if not np.array_equal(enc[name], dec[name]))
+    if bad:
+        raise ValueError("Encryption and decryption states differ at %s" % bad)
+        
+    print "AES-256 Round Trip: [PASS]"
+    
+if __name__ == "__main__":
+    tests = [
+        test_aes128_batch,
+        test_aes128_known_answer,
+        test_batch_models,
+        test_aes256_known_answer,
+        test_aes256_decryption_batch,
+        test_aes256_round_trip,
+    ]
+    
+    for t in tests:
+        t()
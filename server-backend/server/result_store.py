@@ -0,0 +1,264 @@
+"""
+result_store.py
+
+Binary storage for the t-traces of finished results, kept next to the
+project/result database instead of inside it
+"""
+
+import json
+import os
+import tempfile
+import numpy as np
+
+# Type the t-traces are saved as. Single precision is plenty for t-values and
+# halves the size of every result
+trace_dtype = np.float32
+
+# |t| levels that summaries count the samples above
+summary_thresholds = [4.5, 10.0, 20.0]
+
+def result_dir(result_path, pid):
+    """Return the directory holding the t-traces of project pid.
+    """
+    return os.path.join(result_path, '%d' % pid)
+
+def traces_fname(dirname, rid):
+    """Return the filename of the t-traces of result rid.
+    """
+    return os.path.join(dirname, '%d.npy' % rid)
+
+def save_traces(fname, traces):
+    """Write the t-traces of one result as a (number of traces x points) array.
+
+    The file is written under a temporary name and renamed when complete, so
+    readers never see a partial result, and a result that's being re-analyzed
+    keeps its old traces until the new ones are done.
+    """
+    dirname = os.path.dirname(fname)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Another update made it first
+            pass
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        np.save(f, np.asarray(traces, dtype=trace_dtype))
+    os.rename(tmp_fname, fname)
+
+def load_traces(fname):
+    """Open the t-traces of one result without copying them.
+    """
+    return np.load(fname, mmap_mode='r')
+
+def archive_fname(dirname, index):
+    """Return the filename of the archive of every t-trace in a project, 
+    from the index that goes with it.
+    """
+    # Indexes saved before each archive had its own name
+    return os.path.join(dirname, index.get('archive', 'archive.npy'))
+
+def index_fname(dirname):
+    """Return the filename of the index of a project's archive.
+    """
+    return os.path.join(dirname, 'archive.json')
+
+def save_archive(dirname, names, trace_fnames, keys):
+    """Copy the t-traces of every result in a project into one archive.
+
+    The archive is a (number of keys x tests x points) array, so each kind of
+    t-trace is a contiguous (tests x points) matrix that whole-project queries
+    can read sequentially. The index next to it holds the name of each key
+    and test, and the name of the archive file.
+
+    Every build writes a new archive file under a unique name, then renames
+    a new index into place, so a reader always gets an index and archive 
+    that go together, and two builds of one project at once never write 
+    into the same file. The archive that the old index named is deleted.
+
+    Arguments:
+        dirname (string): directory of the project's t-traces
+        names (list of strings): name of each test, in archive order
+        trace_fnames (list of strings): trace file of each test
+        keys (list of strings): name of each row of the trace files
+    """
+    first = load_traces(trace_fnames[0])
+    shape = (len(keys), len(trace_fnames), first.shape[1])
+    del first
+
+    [fd, fname] = tempfile.mkstemp(prefix='archive-', suffix='.npy', dir=dirname)
+    os.close(fd)
+    archive = np.lib.format.open_memmap(fname, mode='w+', dtype=trace_dtype, shape=shape)
+    for [i, f] in enumerate(trace_fnames):
+        archive[:, i, :] = load_traces(f)
+    archive.flush()
+    del archive
+
+    old_fname = None
+    if os.path.exists(index_fname(dirname)):
+        with open(index_fname(dirname)) as f:
+            old_fname = archive_fname(dirname, json.load(f))
+    [fd, tmp_fname] = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'keys':list(keys), 'names':list(names), 'archive':os.path.basename(fname)}, f)
+    os.rename(tmp_fname, index_fname(dirname))
+    if old_fname is not None and os.path.exists(old_fname):
+        os.remove(old_fname)
+
+def load_archive(dirname):
+    """Open a project's archive without copying it.
+
+    Returns:
+        index (dict): 'keys' and 'names' lists, as saved by save_archive()
+        archive (array): memory-mapped (keys x tests x points) array
+    """
+    with open(index_fname(dirname)) as f:
+        index = json.load(f)
+    return index, np.load(archive_fname(dirname, index), mmap_mode='r')
+
+def top_k(matrix, k, max_rows=1024):
+    """Find the k largest |t| values in a (tests x points) matrix.
+
+    The matrix is read in blocks of max_rows tests, so only one block has to
+    be in memory at a time. NaNs count as 0, as in summarize(), so every t 
+    returned is a valid JSON number.
+
+    Returns:
+        list of [test, point, t], largest |t| first
+    """
+    best = []
+    for start in range(0, matrix.shape[0], max_rows):
+        vals = np.nan_to_num(np.asarray(matrix[start:start+max_rows], dtype=np.float64))
+        block = np.abs(vals)
+        flat = block.ravel()
+        n = min(k, len(flat))
+        if n == 0:
+            continue
+        idx = np.argpartition(flat, len(flat) - n)[len(flat) - n:]
+        [rows, cols] = np.unravel_index(idx, block.shape)
+        best.extend([int(start + r), int(c), float(vals[r, c])] for [r, c] in zip(rows, cols))
+        best.sort(key=lambda b: -abs(b[2]))
+        best = best[:k]
+    return best
+
+def summarize(traces, keys, thresholds=summary_thresholds):
+    """Find the statistics of one result that listings and reports need.
+
+    Arguments:
+        traces (2D array): t-traces of the result, one per row
+        keys (list of strings): name of each row (trace_0, trace_1, trace_c,
+            trace_c_<d>)
+        thresholds (list of floats): |t| levels to count the samples above
+
+    Returns:
+        dict with these entries, all plain Python numbers:
+            t_max, i_max: max |t| of trace_c and the point where it is
+            t_max_<x>: max |t| of every other trace_<x>
+            above: number of points of trace_c with |t| above each threshold,
+                keyed by the threshold as a string (as JSON requires)
+    """
+    ret = {}
+    for [i, k] in enumerate(keys):
+        # NaNs come from points with no variance; they never count as leaks
+        tabs = np.abs(np.nan_to_num(np.asarray(traces[i], dtype=np.float64)))
+        name = k[len('trace_'):]
+        if name == 'c':
+            imax = int(np.argmax(tabs))
+            ret['t_max'] = float(tabs[imax])
+            ret['i_max'] = imax
+            ret['above'] = dict(('%g' % t, int(np.count_nonzero(tabs > t))) for t in thresholds)
+        else:
+            ret['t_max_' + name] = float(np.max(tabs))
+    return ret
+
+def test_result_store():
+    import tempfile
+    import shutil
+    result_path = tempfile.mkdtemp()
+    try:
+        dirname = result_dir(result_path, 3)
+        fname = traces_fname(dirname, 7)
+        traces = np.random.randn(3, 100)
+        save_traces(fname, traces)
+        loaded = load_traces(fname)
+        if loaded.dtype != trace_dtype or not isinstance(loaded, np.memmap):
+            raise ValueError("Traces aren't memory-mapped as %s" % np.dtype(trace_dtype))
+        if not np.allclose(loaded, traces, rtol=1e-6):
+            raise ValueError("Loaded traces differ from the saved ones")
+        del loaded
+
+        # Saving again replaces the traces in place
+        save_traces(fname, traces[:2])
+        if load_traces(fname).shape != (2, 100) or os.listdir(dirname) != ['7.npy']:
+            raise ValueError("Saved traces weren't replaced")
+    finally:
+        shutil.rmtree(result_path)
+
+    print "Result Store: [PASS]"
+
+def test_archive():
+    import tempfile
+    import shutil
+    result_path = tempfile.mkdtemp()
+    try:
+        dirname = result_dir(result_path, 3)
+        keys = ['trace_0', 'trace_1', 'trace_c']
+        traces = [np.random.randn(3, 50) for i in range(5)]
+        traces[3][2, 17] = -40.0
+        traces[1][2, 5] = 30.0
+        traces[0][2, :] = np.nan
+        fnames = [traces_fname(dirname, i) for i in range(5)]
+        for [f, t] in zip(fnames, traces):
+            save_traces(f, t)
+        save_archive(dirname, ['test %d' % i for i in range(5)], fnames, keys)
+
+        [index, archive] = load_archive(dirname)
+        if index['keys'] != keys or index['names'][3] != 'test 3' or archive.shape != (3, 5, 50):
+            raise ValueError("Archive has the wrong layout")
+        if not np.allclose(archive[2, 4], traces[4][2], rtol=1e-6):
+            raise ValueError("Archived traces differ from the saved ones")
+
+        # Use small blocks to check that they're merged correctly
+        top = top_k(archive[2], 2, max_rows=2)
+        if [t[:2] for t in top] != [[3, 17], [1, 5]] or top[0][2] != -40.0:
+            raise ValueError("Wrong top |t| values: %s" % top)
+        if any(np.isnan(t[2]) for t in top_k(archive[2], 150)):
+            raise ValueError("Top |t| values include NaNs")
+        del archive
+
+        # Building again replaces both files together
+        save_archive(dirname, ['test 0', 'test 1'], fnames[:2], keys)
+        [index, archive] = load_archive(dirname)
+        if index['names'] != ['test 0', 'test 1'] or archive.shape != (3, 2, 50):
+            raise ValueError("Rebuilt archive doesn't match its index")
+        del archive
+        others = sorted(f for f in os.listdir(dirname) if not f[0].isdigit())
+        if others != [index['archive'], 'archive.json']:
+            raise ValueError("Old or temporary archive files were left: %s" % others)
+    finally:
+        shutil.rmtree(result_path)
+
+    print "Archive: [PASS]"
+
+def test_summarize():
+    trace_c = np.array([0.5, -12.0, np.nan, 5.0, 30.0])
+    traces = np.array([[1.0, -2.0, 0, 0, 0], [0, 0, 3.0, 0, 0], trace_c, -trace_c])
+    summary = summarize(traces, ['trace_0', 'trace_1', 'trace_c', 'trace_c_2'])
+    if summary['t_max'] != 30.0 or summary['i_max'] != 4:
+        raise ValueError("Wrong max |t| for trace_c: %s" % summary)
+    if summary['t_max_0'] != 2.0 or summary['t_max_1'] != 3.0 or summary['t_max_c_2'] != 30.0:
+        raise ValueError("Wrong max |t| for the other traces: %s" % summary)
+    if summary['above'] != {'4.5':3, '10':2, '20':1}:
+        raise ValueError("Wrong counts above thresholds: %s" % summary['above'])
+
+    print "Summarize: [PASS]"
+
+if __name__ == "__main__":
+    tests = [
+        test_result_store,
+        test_archive,
+        test_summarize,
+    ]
+
+    for t in tests:
+        t()
@@ -12,7 +12,15 @@
 #
 # GET /results: get a list of all results
 # 
-# GET /results/<id>: get one test result
+# GET /results/<id>: get one test result (add ?traces=list to get the t-traces
+#   as lists instead of URIs)
+# GET /results/<id>/traces/<name>: download one t-trace as a .npy file
+#
+# GET /archives/<id>: describe the t-trace archive of a finished project
+# GET /archives/<id>/download: download the whole archive as a .npy file
+# GET /archives/<id>/traces/<key>?tests=a:b&points=c:d: get a slice of one
+#   kind of t-trace (trace_0, trace_1, trace_c, ...) for a range of tests
+# GET /archives/<id>/top/<key>?k=n: get the n largest |t| values of a project
 
 import interface
 
@@ -86,6 +94,7 @@ def gen_inifile(fname):
     config['Paths']['db_path'] = 'db'
     config['Options'] = {}
     config['Options']['random_id'] = 'True'
+    config['Options']['flush_interval'] = '1.0'
     print "Writing to %s..." % fname
     with open(fname, "w") as f:
         config.write(f)
@@ -103,12 +112,14 @@ def load_inifile(ini_file):
         random_id = config.getboolean('Options', 'random_id')
         trace_path = config['Paths']['trace_path']
         configopt_path = config['Paths']['config_path']
+        # Seconds that finished results can wait before they're saved
+        flush_interval = config.getfloat('Options', 'flush_interval', fallback=None)
     except configparser.NoOptionError as e: 
         print "error: missing option in %s" % ini_file
         print e.message
         sys.exit(2)
         
-    return log_file, db_path, random_id, trace_path, configopt_path
+    return log_file, db_path, random_id, trace_path, configopt_path, flush_interval
     
 def usage(exit_code):
     print "usage: python server.py [config_file]"
@@ -157,9 +168,9 @@ def create_app(config_file="server.ini"):
         usage(2)
 
     # Load settings from ini file
-    log_file, db_path, random_id, trace_path, option_path = load_inifile(config_file)
+    log_file, db_path, random_id, trace_path, option_path, flush_interval = load_inifile(config_file)
     log.init_log(log_file)
-    interface.init(db_path, random_id, trace_path, option_path)
+    interface.init(db_path, random_id, trace_path, option_path, flush_interval)
     
     # Stop Werkzeug logging
     
@@ -9,6 +9,8 @@ import os
 import random
 random.seed()
 import shelve
+import numpy as np
+import result_store
 
 projects = results = None
 # TODO: get this from command line
@@ -159,6 +161,18 @@ class ListStore(object):
         ret = [int(k) for k in klist if k.isdigit()]
         return ret
         
+    def get_many(self, ids):
+        """Return a dict of the items with IDs in ids, leaving out the ones
+        that aren't in the list.
+        """
+        return dict((id, self._data[str(id)]) for id in ids if str(id) in self._data)
+        
+    def set_many(self, items):
+        """Save every item in a dict of items by ID.
+        """
+        for id in items:
+            self[id] = items[id]
+        
     def close(self):
         self._data.close()
 
@@ -172,27 +186,72 @@ class Project(object):
         id (int, read-only): A unique identifier for each project
         cwproject (string): Server-side path to ChipWhisperer project
         config (string): Server-side path to analysis config file
-        num_threads (int): Maximum number of worker threads
+        num_threads (int): No longer used; every project shares the worker
+            service, which has one process per core
         remaining (int): Number of unfinished results
         running (bool): Whether the results are currently being computed
         results (list of int, read-only): List of t-test result IDs associated
             with this project
         status (string, read-only): current project state
+        incremental (bool): Whether to save the t-test sums so that the 
+            analysis can be extended when traces are added to the cwproject
+        order (int): Highest order of univariate t-test to compute; results
+            get a higher-order t-trace for every order from 2 up to this
+        curve (bool): Whether to sample max |t| against the number of traces
+            while the traces are analyzed
+        windows (list of [start, stop]): Sample ranges to analyze, or None 
+            for the whole trace
+        decimate (int): Number of consecutive samples to average into each 
+            analyzed point
+        samples (list of int, read-only): Sample index in the cwproject 
+            traces of each point in the results, or None if every sample is 
+            analyzed
+        numtraces (int, read-only): Number of traces covered by the saved 
+            t-test sums (0 if there are none)
+        fingerprint (string, read-only): Fingerprint of the traces and config
+            file covered by the saved t-test sums
+        archived (bool, read-only): Whether the archive of the project's 
+            t-traces is ready
     """
     
-    def __init__(self, cwproject='', config='', num_threads=1, title=''):
+    # Defaults for projects saved before these attributes existed
+    incremental = False
+    order = 1
+    curve = False
+    windows = None
+    decimate = 1
+    samples = None
+    numtraces = 0
+    fingerprint = None
+    next_numtraces = 0
+    next_fingerprint = None
+    archived = False
+    
+    def __init__(self, cwproject='', config='', num_threads=1, title='', incremental=False, order=1, curve=False, windows=None, decimate=1):
         self.id = projects.next_id()
         
         self.cwproject = cwproject
         self.config = config
         self.num_threads = num_threads
         self.title = title
+        self.incremental = incremental
+        self.order = order
+        self.curve = curve
+        self.windows = windows
+        self.decimate = decimate
+        self.samples = None
         
         self.remaining = 0
         self.running = False
         self.results = []
         self.status = ''
         
+        self.numtraces = 0
+        self.fingerprint = None
+        self.next_numtraces = 0
+        self.next_fingerprint = None
+        self.archived = False
+        
         projects[self.id] = self  
 
 class Result(object):
@@ -207,27 +266,80 @@ class Result(object):
         name (string): Name of test for this result
         status (string): Current state of this result, such as "not started", 
             "in progress", or "finished"
-        data (dict): The output of the t-test
-            trace_0 (list of floats): T-test trace for half of traces
-            trace_1 (list of floats): T-test trace for other half of traces
-            trace_c (list of floats): Combined t-test values        
+        data (dict): The output of the t-test, other than the t-traces
+            curve (dict): Only for projects with curve set: 'numtraces', 
+                't_max' and 'i_max' lists giving max |t| over the first n 
+                traces and its sample index, for a geometric series of n
+            curve_<d> (dict): Same as curve, for each higher order d
+        trace_fname (string): File holding the t-traces, or None if there are 
+            none yet (results saved before the t-traces were moved out of the 
+            database keep them in data instead)
+        trace_keys (list of strings): Name of each row of the t-trace file:
+            trace_0 (T-test trace for half of traces)
+            trace_1 (T-test trace for other half of traces)
+            trace_c (Combined t-test values)
+            trace_c_<d> (Combined t-test values of order d, for each order 
+                from 2 up to the project's order)
+        summary (dict): Statistics of the t-traces, saved when the result 
+            finishes (see result_store.summarize()), or None if there are 
+            no t-traces yet
     """
     
+    # Defaults for results saved before these attributes existed
+    trace_fname = None
+    trace_keys = []
+    summary = None
+    
     def __init__(self, pid=0, name=''):
         self.id = results.next_id()
         self.pid = pid
         self.name = name
         self.status = ''
         self.data = {}
+        self.trace_fname = None
+        self.trace_keys = []
+        self.summary = None
         
         results[self.id] = self
+        
+    def traces(self):
+        """Return the t-traces of this result as a dict of arrays by name.
+        
+        The arrays are memory-mapped from the result's trace file, so only 
+        the parts that are used get read.
+        """
+        if self.trace_fname is None:
+            return dict((k, np.asarray(v)) for [k, v] in self.data.items() if k.startswith('trace_'))
+        buf = result_store.load_traces(self.trace_fname)
+        return dict((k, buf[i]) for [i, k] in enumerate(self.trace_keys))
+        
+    def get_summary(self):
+        """Return the summary of this result.
+        
+        Results that finished before summaries were saved have theirs 
+        worked out from the t-traces.
+        """
+        if self.summary is None:
+            traces = self.traces()
+            if 'trace_c' in traces:
+                keys = sorted(traces.keys())
+                return result_store.summarize([traces[k] for k in keys], keys)
+        return self.summary
+
+def open_store(fname):
+    """Open a ListStore, or an SQLStore if fname is an SQLite file.
+    """
+    if fname is not None and os.path.splitext(fname)[1] == '.sqlite':
+        import sql_db
+        return sql_db.SQLStore(fname)
+    return ListStore(fname)
 
 def open_db(proj_fname, res_fname):
     global projects, results
     
     print "Opening database connections..."
-    projects = ListStore(proj_fname)
-    results = ListStore(res_fname)
+    projects = open_store(proj_fname)
+    results = open_store(res_fname)
     print "Database loaded"
     
 def close_db():
@@ -0,0 +1,321 @@
+"""
+sql_db.py
+
+SQLite storage for projects and results, with the same interface as
+shelve_db.ListStore
+"""
+
+import cPickle as pickle
+import glob
+import json
+import os
+import random
+random.seed()
+import shelve
+import sqlite3
+import threading
+
+default_max_id = 2**32
+default_last_id = 0
+
+class SQLStore(object):
+    """A dictionary of items by integer ID, saved in an SQLite database.
+
+    This is a drop-in replacement for shelve_db.ListStore. Each item is
+    pickled into its own row, next to copies of its pid, name and status
+    attributes (if it has them). Those columns are indexed, so the items
+    belonging to a project can be found without unpickling every item in
+    the store. An item's summary attribute is also copied, as JSON, so 
+    summaries can be listed without unpickling the items either.
+
+    Every write is its own transaction, and the database uses a write-ahead
+    log, so a crash never leaves a half-written item behind.
+
+    Attributes:
+        max_id (int): For random ID generation, the maximum possible ID number.
+        last_id (int): For sequential ID generation, the previous sequential ID.
+    """
+
+    def __init__(self, db_fname, max_id = None, last_id = None):
+        """Open the database, creating its tables if needed
+
+        Arguments:
+            db_fname (string): name of SQLite DB file, or None to keep the
+                database in memory
+            max_id (int): Max ID for random ID generation. If None, loads from
+                the DB file or uses default value (2^32)
+            last_id (int): Previous ID for sequential ID generation. If None,
+                loads from the DB file
+        """
+        if db_fname is None:
+            print "WARNING: Falling back to in-memory db"
+            db_fname = ':memory:'
+        else:
+            dirname = os.path.dirname(db_fname)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+
+        # The server uses the store from the Flask thread and the worker
+        # callback thread, so access is serialized here
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_fname, check_same_thread=False)
+        with self._lock:
+            if db_fname != ':memory:':
+                self._conn.execute('PRAGMA journal_mode=WAL')
+            with self._conn:
+                self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+                self._conn.execute('CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, pid INTEGER, name TEXT, status TEXT, item BLOB, summary TEXT)')
+                columns = [row[1] for row in self._conn.execute('PRAGMA table_info(items)')]
+                if 'summary' not in columns:
+                    # Made before summaries were saved
+                    self._conn.execute('ALTER TABLE items ADD COLUMN summary TEXT')
+                self._conn.execute('CREATE INDEX IF NOT EXISTS items_pid ON items (pid)')
+                self._conn.execute('CREATE INDEX IF NOT EXISTS items_status ON items (status)')
+                self._conn.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', ('max_id', default_max_id))
+                self._conn.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', ('last_id', default_last_id))
+        if max_id is not None:
+            self._set_meta('max_id', max_id)
+        if last_id is not None:
+            self._set_meta('last_id', last_id)
+
+    def _get_meta(self, key):
+        with self._lock:
+            return self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()[0]
+
+    def _set_meta(self, key, value):
+        with self._lock:
+            with self._conn:
+                self._conn.execute('UPDATE meta SET value = ? WHERE key = ?', (value, key))
+
+    def _check_id(self, id):
+        if not isinstance(id, (long, int)):
+            raise TypeError("ID %s is not an integer" % id)
+
+    def sync(self):
+        # Every write is committed as it happens
+        pass
+
+    @property
+    def max_id(self):
+        return self._get_meta('max_id')
+
+    @property
+    def last_id(self):
+        return self._get_meta('last_id')
+
+    @last_id.setter
+    def last_id(self, value):
+        self._check_id(value)
+        self._set_meta('last_id', value)
+
+    def next_id(self, random_id=False):
+        """Returns the next ID to be used.
+        """
+        with self._lock:
+            if random_id:
+                while True:
+                    id = random.randint(0, self.max_id-1)
+                    if id not in self:
+                        return id
+            else:
+                while True:
+                    self.last_id += 1
+                    if self.last_id not in self:
+                        return self.last_id
+
+    def __contains__(self, id):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM items WHERE id = ?', (id,)).fetchone() is not None
+
+    def __getitem__(self, id):
+        self._check_id(id)
+        with self._lock:
+            row = self._conn.execute('SELECT item FROM items WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            raise KeyError("ID %d is not in list" % id)
+        return pickle.loads(str(row[0]))
+
+    def _row(self, id, value):
+        self._check_id(id)
+        summary = getattr(value, 'summary', None)
+        if summary is not None:
+            summary = json.dumps(summary)
+        return (id, getattr(value, 'pid', None), getattr(value, 'name', None), getattr(value, 'status', None),
+                sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), summary)
+
+    def __setitem__(self, id, value):
+        self.set_many({id: value})
+
+    def set_many(self, items):
+        """Save every item in a dict of items by ID, in one transaction.
+        """
+        rows = [self._row(id, items[id]) for id in items]
+        with self._lock:
+            with self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO items (id, pid, name, status, item, summary) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def __delitem__(self, id):
+        self._check_id(id)
+        with self._lock:
+            with self._conn:
+                cur = self._conn.execute('DELETE FROM items WHERE id = ?', (id,))
+        if cur.rowcount == 0:
+            raise KeyError("ID %d is not in list" % id)
+
+    def keys(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute('SELECT id FROM items ORDER BY id')]
+
+    def find(self, pid=None, status=None):
+        """Return the IDs of the items with the given pid and/or status.
+        """
+        where = []
+        args = []
+        if pid is not None:
+            where.append('pid = ?')
+            args.append(pid)
+        if status is not None:
+            where.append('status = ?')
+            args.append(status)
+        query = 'SELECT id FROM items'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        with self._lock:
+            return [row[0] for row in self._conn.execute(query + ' ORDER BY id', args)]
+
+    def get_many(self, ids):
+        """Return a dict of the items with IDs in ids, read in one query.
+
+        IDs that aren't in the store are left out.
+        """
+        ids = list(ids)
+        ret = {}
+        with self._lock:
+            # Stay under SQLite's limit on the number of query parameters
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                query = 'SELECT id, item FROM items WHERE id IN (%s)' % ','.join('?' * len(chunk))
+                for [id, item] in self._conn.execute(query, chunk):
+                    ret[id] = pickle.loads(str(item))
+        return ret
+
+    def get_summaries(self, ids):
+        """Return the name, status and summary of the items with IDs in ids,
+        without unpickling them.
+
+        Returns:
+            dict mapping each ID found to a dict with name, status and summary
+            entries. summary is None for items that don't have one saved.
+        """
+        ids = list(ids)
+        ret = {}
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                query = 'SELECT id, name, status, summary FROM items WHERE id IN (%s)' % ','.join('?' * len(chunk))
+                for [id, name, status, summary] in self._conn.execute(query, chunk):
+                    if summary is not None:
+                        summary = json.loads(summary)
+                    ret[id] = {'name':name, 'status':status, 'summary':summary}
+        return ret
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def shelve_exists(fname):
+    """Check if a shelve database was saved under fname.
+
+    Depending on the dbm module, shelve adds its own extensions to the name.
+    """
+    return len(glob.glob(fname + '*')) > 0
+
+def migrate_shelve(shelve_fname, sql_fname):
+    """Copy every item in a shelve_db.ListStore file into an SQLStore.
+
+    Items that are already in the SQL database are overwritten.
+
+    Returns:
+        (int): number of items copied
+    """
+    src = shelve.open(shelve_fname, 'r')
+    dst = SQLStore(sql_fname)
+    try:
+        if 'max_id' in src:
+            dst._set_meta('max_id', src['max_id'])
+        if 'last_id' in src:
+            dst.last_id = max(src['last_id'], dst.last_id)
+        n = 0
+        for k in src.keys():
+            if k.isdigit():
+                dst[int(k)] = src[k]
+                n += 1
+        return n
+    finally:
+        src.close()
+        dst.close()
+
+class _TestItem(object):
+    def __init__(self, pid, status):
+        self.pid = pid
+        self.status = status
+        self.summary = {'t_max':float(pid)} if status == 'finished' else None
+
+def test_sqlstore():
+    ls = SQLStore(None)
+    for i in range(10):
+        id = ls.next_id(True)
+        ls[id] = i
+    if len(ls.keys()) != 10 or sorted(ls[k] for k in ls.keys()) != range(10):
+        raise ValueError("Store lost items")
+
+    seq = SQLStore(None, last_id=100)
+    for i in range(6):
+        id = seq.next_id()
+        seq[id] = _TestItem(i % 2, 'finished' if i < 4 else 'running')
+    if seq.keys() != range(101, 107):
+        raise ValueError("Sequential IDs are wrong")
+    if seq.find(pid=1) != [102, 104, 106] or seq.find(pid=0, status='finished') != [101, 103]:
+        raise ValueError("Indexed lookups are wrong")
+    if sorted(seq.get_many([101, 105, 999]).keys()) != [101, 105]:
+        raise ValueError("Bulk lookups are wrong")
+    seq.set_many({107: _TestItem(1, 'running'), 108: _TestItem(0, 'running')})
+    if seq.find(status='running') != [105, 106, 107, 108]:
+        raise ValueError("Bulk writes are wrong")
+    summaries = seq.get_summaries([102, 105])
+    if summaries[102]['summary'] != {'t_max':1.0} or summaries[105]['summary'] is not None:
+        raise ValueError("Summary lookups are wrong")
+
+    del seq[101]
+    try:
+        seq[101]
+        raise AssertionError("Deleted item is still in the store")
+    except KeyError:
+        pass
+
+    print "SQL Store: [PASS]"
+
+def usage():
+    print "usage: python sql_db.py db_path"
+    print "Copy the projects.db and results.db shelve files in db_path into"
+    print "projects.sqlite and results.sqlite, for the SQL backend"
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) == 2:
+        for name in ['projects', 'results']:
+            src = os.path.join(sys.argv[1], name + '.db')
+            dst = os.path.join(sys.argv[1], name + '.sqlite')
+            if not shelve_exists(src):
+                print "No shelve database at %s, skipping" % src
+                continue
+            print "Copied %d items from %s to %s" % (migrate_shelve(src, dst), src, dst)
+    elif len(sys.argv) == 1:
+        tests = [
+            test_sqlstore,
+        ]
+
+        for t in tests:
+            t()
+    else:
+        usage()
@@ -0,0 +1,86 @@
+"""
+state_store.py
+
+Saved t-test accumulator state, used to re-analyze projects incrementally
+when more traces are added to them
+"""
+
+import glob
+import hashlib
+import os
+import numpy as np
+
+def state_dir(state_path, pid):
+    """Return the directory holding the saved state of project pid.
+    """
+    return os.path.join(state_path, '%d' % pid)
+
+def totals_fname(dirname, numtraces):
+    """Return the filename of the trace totals after numtraces traces.
+    """
+    return os.path.join(dirname, 'totals_%d.npz' % numtraces)
+
+def result_fname(dirname, rid, numtraces):
+    """Return the filename of the sums for result rid after numtraces traces.
+    """
+    return os.path.join(dirname, '%d_%d.npz' % (rid, numtraces))
+
+def fingerprint(config_fname, tracelen, pt, key, order=1, windows=None, decimate=1):
+    """Identify a set of traces and the configuration used to analyze them.
+
+    Saved state can only be extended if the new project starts with exactly
+    the same traces, uses the same config file and sample windows, and 
+    collects the power sums for the same t-test order.
+    """
+    h = hashlib.sha1()
+    with open(config_fname, 'rb') as f:
+        h.update(f.read())
+    h.update(str(tracelen))
+    h.update(str(order))
+    h.update(str(windows))
+    h.update(str(decimate))
+    h.update(np.ascontiguousarray(pt).tobytes())
+    h.update(np.ascontiguousarray(key).tobytes())
+    return h.hexdigest()
+
+def save_state(fname, arrays):
+    """Write a dictionary of arrays to fname.
+
+    The file is written under a temporary name and renamed when complete, so
+    an interrupted analysis never leaves a partial state file behind.
+    """
+    dirname = os.path.dirname(fname)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Another worker made it first
+            pass
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(tmp_fname, fname)
+
+def load_state(fname):
+    """Read a dictionary of arrays written by save_state().
+    """
+    with np.load(fname) as f:
+        return dict((k, f[k]) for k in f.files)
+
+def has_state(dirname, rids, numtraces):
+    """Check that the totals and every result's sums exist for numtraces.
+    """
+    if not os.path.exists(totals_fname(dirname, numtraces)):
+        return False
+    for rid in rids:
+        if not os.path.exists(result_fname(dirname, rid, numtraces)):
+            return False
+    return True
+
+def clean_state(dirname, numtraces):
+    """Delete all of the saved state except for the sums after numtraces.
+    """
+    suffix = '_%d.npz' % numtraces
+    for fname in glob.glob(os.path.join(dirname, '*.npz*')):
+        if not fname.endswith(suffix):
+            os.remove(fname)
@@ -0,0 +1,142 @@
+"""
+trace_store.py
+
+Project-level trace storage shared between analysis processes
+"""
+
+import os
+import numpy as np
+import chipwhisperer.common.api.TraceManager as cwtm
+
+def store_fname(store_path, pid):
+    """Return the filename of the trace block for project pid.
+    """
+    return os.path.join(store_path, 'traces_%d.npy' % pid)
+
+def sample_blocks(tracelen, windows=None, decimate=1):
+    """Find the samples that make up each point of a published trace.
+
+    Arguments:
+        tracelen (int): number of samples in each trace of the project
+        windows (list of [start, stop]): sample ranges to keep, clipped to
+            the trace (default: the whole trace)
+        decimate (int): number of consecutive samples in a window to average
+            into each point; a shorter block is left at the end of a window
+            that isn't a multiple of decimate
+
+    Returns:
+        index (array of int): samples to keep, in order
+        offsets (array of int): position in index of the first sample of
+            each point
+    """
+    if not windows:
+        windows = [[0, tracelen]]
+    index = []
+    offsets = []
+    for [lo, hi] in windows:
+        lo = max(lo, 0)
+        hi = min(hi, tracelen)
+        for s in range(lo, hi, decimate):
+            offsets.append(len(index))
+            index.extend(range(s, min(s + decimate, hi)))
+    return np.array(index, dtype=int), np.array(offsets, dtype=int)
+
+def sample_points(tracelen, windows=None, decimate=1):
+    """Return the project sample index of the first sample of each point.
+    """
+    [index, offsets] = sample_blocks(tracelen, windows, decimate)
+    return index[offsets]
+
+def publish_traces(proj_name, fname, start=0, windows=None, decimate=1):
+    """Load the traces in a ChipWhisperer project into a .npy file.
+
+    The traces are copied one at a time into a memmapped array, so the full
+    trace set never has to fit in RAM. The file is written under a temporary
+    name and renamed when complete, so readers never see a partial block.
+
+    Only the samples in the windows are kept, averaged over blocks of
+    decimate samples, so everything downstream works on the reduced traces.
+
+    Arguments:
+        proj_name (string): filename of the ChipWhisperer project
+        fname (string): filename of the .npy file to create
+        start (int): index of the first trace to copy; row i of the block
+            holds trace start+i
+        windows, decimate: samples to keep; see sample_blocks()
+
+    Returns:
+        numtraces (int): number of traces in the project
+        tracelen (int): number of points in each published trace
+    """
+    tm = cwtm.TraceManager()
+    tm.loadProject(proj_name)
+    numtraces = tm.numTraces()
+    [index, offsets] = sample_blocks(tm.numPoints(), windows, decimate)
+    tracelen = len(offsets)
+    if tracelen == 0:
+        raise ValueError("No samples left in the traces after applying windows %s" % windows)
+    counts = np.diff(np.append(offsets, len(index)))
+    reduce_trace = (decimate > 1)
+
+    dirname = os.path.dirname(fname)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    tmp_fname = fname + '.tmp'
+    dtype = np.asarray(tm.getTrace(0)).dtype
+    if reduce_trace:
+        dtype = np.result_type(dtype, np.float32)
+    traces = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=dtype, shape=(numtraces - start, tracelen))
+    for i in range(start, numtraces):
+        trace = np.asarray(tm.getTrace(i))[index]
+        if reduce_trace:
+            trace = np.add.reduceat(trace, offsets, dtype=np.float64) / counts
+        traces[i - start] = trace
+    traces.flush()
+    del traces
+    os.rename(tmp_fname, fname)
+
+    return numtraces, tracelen
+
+def attach_traces(fname):
+    """Open a published trace block without copying it.
+
+    The block is memory-mapped read-only, so every process that attaches to
+    it shares the same pages from the OS cache.
+    """
+    return np.load(fname, mmap_mode='r')
+
+def buffer_fname(store_path, pid):
+    """Return the filename of the result buffer for project pid.
+    """
+    return os.path.join(store_path, 'results_%d.npy' % pid)
+
+def group_fname(store_path, pid):
+    """Return the filename of the group store for project pid.
+    """
+    return os.path.join(store_path, 'groups_%d.npy' % pid)
+
+def create_buffer(fname, shape, dtype=np.float64):
+    """Make a .npy file for the worker processes to write their results into.
+
+    Each worker writes its own rows (or columns) through attach_buffer(), so 
+    results never have to be pickled back to the server process.
+    """
+    dirname = os.path.dirname(fname)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    buf = np.lib.format.open_memmap(fname, mode='w+', dtype=dtype, shape=shape)
+    buf.flush()
+    del buf
+
+def attach_buffer(fname):
+    """Open a result buffer for writing without copying it.
+    """
+    return np.load(fname, mmap_mode='r+')
+
+def release_traces(fname):
+    """Remove a published trace block (or result buffer) once the analysis is 
+    done with it.
+    """
+    if os.path.exists(fname):
+        os.remove(fname)
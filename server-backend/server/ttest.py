@@ -0,0 +1,670 @@
+"""
+ttest.py
+
+Batched t-tests: many groupings of the same traces evaluated at once
+"""
+
+import hashlib
+import numpy as np
+from scipy.special import comb
+
+def classify_groups(groups):
+    """Decide which t-test to use for each grouping.
+
+    Groupings with exactly two distinct values use a Welch t-test between the
+    two partitions; all others use a Student t-test on the regression of the
+    traces against the group values.
+
+    Arguments:
+        groups (num_tests x numtraces array of int): one grouping per row
+
+    Returns:
+        is_welch (array of bool): True if the row should use a Welch t-test
+        true_val (array of int): for Welch rows, the group value that is
+            treated as the "true" partition (the smaller of the two values)
+    """
+    return classify_ranges(group_ranges(groups))
+
+def group_ranges(groups):
+    """Find the range of values taken by each grouping.
+
+    This is everything classify_groups() looks at, so the ranges of two sets
+    of traces can be combined with merge_ranges() and classified without
+    going back to the groupings of the first set.
+
+    Returns:
+        lo, hi (arrays of int): smallest and largest value in each row
+        two_vals (array of bool): True if the row takes no values other than
+            lo and hi
+    """
+    groups = np.asarray(groups)
+    lo = groups.min(axis=1)
+    hi = groups.max(axis=1)
+    two_vals = np.all((groups == lo[:, None]) | (groups == hi[:, None]), axis=1)
+    return lo, hi, two_vals
+
+def merge_ranges(a, b):
+    """Combine the group_ranges() of two sets of traces.
+    """
+    lo = np.minimum(a[0], b[0])
+    hi = np.maximum(a[1], b[1])
+    two_vals = np.ones(len(lo), dtype=bool)
+    for [r_lo, r_hi, r_two] in [a, b]:
+        # Each set can only take the values at the ends of the combined range
+        two_vals &= r_two & ((r_lo == lo) | (r_lo == hi)) & ((r_hi == lo) | (r_hi == hi))
+    return lo, hi, two_vals
+
+def classify_ranges(ranges):
+    """Decide which t-test to use for each grouping from its group_ranges().
+    """
+    [lo, hi, two_vals] = ranges
+    return two_vals & (lo != hi), lo
+
+def unique_groups(groups, is_welch, true_val):
+    """Find the distinct groupings, so each t-test only has to run once.
+
+    Welch groupings are compared by the partition they make, so a grouping
+    that is the exact complement of another (the same traces in the true
+    group of one as in the false group of the other) gives the same t-test
+    with the opposite sign. Other groupings must be identical.
+
+    Each grouping is identified by a SHA-1 fingerprint of its canonical form,
+    so only the fingerprints of the distinct groupings are kept in memory.
+
+    Arguments:
+        groups (num_tests x numtraces array of int): one grouping per row
+        is_welch, true_val: output of classify_groups() for the groupings
+
+    Returns:
+        uniq (array of int): row of the first grouping of each distinct kind
+        index (array of int): for each row, position of its grouping in uniq
+        sign (array of int): for each row, +1 if its t-test is equal to the
+            one for uniq[index], or -1 if it is the negative
+    """
+    groups = np.asarray(groups)
+    seen = {}
+    uniq = []
+    index = np.zeros(len(groups), dtype=int)
+    sign = np.ones(len(groups), dtype=int)
+
+    for i in range(len(groups)):
+        if is_welch[i]:
+            # Orient every partition so the first trace is in the true group
+            b = (groups[i] == true_val[i])
+            flip = len(b) > 0 and not b[0]
+            if flip:
+                b = ~b
+            key = 'w' + hashlib.sha1(np.packbits(b).tobytes()).digest()
+        else:
+            flip = False
+            key = 's' + hashlib.sha1(np.ascontiguousarray(groups[i]).tobytes()).digest()
+
+        if key not in seen:
+            seen[key] = (len(uniq), flip)
+            uniq.append(i)
+        [index[i], first_flip] = seen[key]
+        if flip != first_flip:
+            sign[i] = -1
+
+    return np.array(uniq, dtype=int), index, sign
+
+class TTestAccumulator(object):
+    """Running sufficient statistics for a batch of t-tests.
+
+    Traces are added chunk by chunk with update(), so memory use is bounded
+    by the chunk size and the number of tests, no matter how many traces are
+    processed. The t-statistics can be computed from the sums at any time.
+
+    Every trace is shifted by a per-sample offset before it is accumulated;
+    this doesn't change the t-statistics but keeps the sums of squares from
+    losing precision when the traces have a large DC level.
+
+    For higher-order tests, the sums of the higher powers of the traces are
+    accumulated in the same pass, so the univariate t-tests of every order up
+    to the accumulator's order can be computed from one read of the traces.
+
+    Attributes:
+        is_welch, true_val: output of classify_groups() for the batch
+        offset (array of float): per-sample shift, taken from the first chunk
+            if not given
+        order (int): highest order of t-test that can be computed
+        n (int): number of traces accumulated
+        S, Q (array of float): sum and sum of squares of all traces
+        n1 (array of int): per Welch test, number of traces in the true group
+        S1, Q1 (Welch tests x tracelen array): sum and sum of squares of the
+            true group
+        S_x, S_xx (array of float): per Student test, sums of x and x^2
+        S_xy (Student tests x tracelen array): sum of x*y
+        P (2*order-2 x tracelen array): sums of y^3 ... y^(2*order) of all
+            traces (only if order > 1)
+        P1 (Welch tests x 2*order-2 x tracelen array): sums of y^3 ...
+            y^(2*order) of the true group (only if order > 1)
+        S_xP (Student tests x order-1 x tracelen array): sums of x*y^2 ...
+            x*y^order (only if order > 1)
+    """
+
+    # Names of the sums over all traces, per Welch test and per Student test
+    total_keys = ['n', 'S', 'Q']
+    welch_keys = ['n1', 'S1', 'Q1']
+    student_keys = ['S_x', 'S_xx', 'S_xy']
+
+    def __init__(self, is_welch, true_val, tracelen, offset=None, order=1):
+        self.is_welch = np.asarray(is_welch, dtype=bool)
+        self.true_val = np.asarray(true_val)
+        self.welch = np.flatnonzero(self.is_welch)
+        self.student = np.flatnonzero(~self.is_welch)
+        self.tracelen = tracelen
+        self.offset = offset
+        self.order = order
+
+        self.n = 0
+        self.S = np.zeros(tracelen)
+        self.Q = np.zeros(tracelen)
+
+        self.n1 = np.zeros(len(self.welch))
+        self.S1 = np.zeros((len(self.welch), tracelen))
+        self.Q1 = np.zeros((len(self.welch), tracelen))
+
+        self.S_x = np.zeros(len(self.student))
+        self.S_xx = np.zeros(len(self.student))
+        self.S_xy = np.zeros((len(self.student), tracelen))
+
+        if order > 1:
+            self.total_keys = self.total_keys + ['P']
+            self.welch_keys = self.welch_keys + ['P1']
+            self.student_keys = self.student_keys + ['S_xP']
+            self.P = np.zeros((2*order - 2, tracelen))
+            self.P1 = np.zeros((len(self.welch), 2*order - 2, tracelen))
+            self.S_xP = np.zeros((len(self.student), order - 1, tracelen))
+
+    def update(self, groups, traces):
+        """Add a chunk of traces to the sums.
+
+        Arguments:
+            groups (num_tests x chunk array of int): groupings for this chunk
+            traces (chunk x tracelen array): traces in this chunk
+        """
+        if len(traces) == 0:
+            return
+        y = np.asarray(traces, dtype=np.float64)
+        if self.offset is None:
+            self.offset = np.mean(y, axis=0)
+        y = y - self.offset
+        y2 = y**2
+        groups = np.asarray(groups)
+
+        self.n += len(y)
+        self.S += np.sum(y, axis=0)
+        self.Q += np.sum(y2, axis=0)
+
+        if len(self.welch) > 0:
+            g = (groups[self.welch] == self.true_val[self.welch, None]).astype(np.float64)
+            self.n1 += np.sum(g, axis=1)
+            self.S1 += np.dot(g, y)
+            self.Q1 += np.dot(g, y2)
+
+        if len(self.student) > 0:
+            x = groups[self.student].astype(np.float64)
+            self.S_x += np.sum(x, axis=1)
+            self.S_xx += np.sum(x**2, axis=1)
+            self.S_xy += np.dot(x, y)
+
+        # Higher powers reuse the chunk that is already in memory
+        yk = y2
+        for k in range(2, 2*self.order + 1):
+            if k > 2:
+                yk = yk * y
+                self.P[k-3] += np.sum(yk, axis=0)
+                if len(self.welch) > 0:
+                    self.P1[:, k-3] += np.dot(g, yk)
+            if k <= self.order and len(self.student) > 0:
+                self.S_xP[:, k-2] += np.dot(x, yk)
+
+    def merge(self, other, sign=1):
+        """Add (or, with sign=-1, remove) the sums of another accumulator.
+
+        The other accumulator must have the same tests and offset.
+        """
+        self.n += sign * other.n
+        for k in self.total_keys + self.welch_keys + self.student_keys:
+            if k != 'n':
+                setattr(self, k, getattr(self, k) + sign * getattr(other, k))
+
+    def expand(self, index, sign):
+        """Make an accumulator with one test per result from unique groupings.
+
+        Arguments:
+            index, sign: output of unique_groups() for the results, with
+                index giving the position of each result's grouping in this
+                accumulator
+
+        Returns:
+            (TTestAccumulator): sums for every result. Results with sign -1
+                get the sums of the complement of the true group.
+        """
+        index = np.asarray(index)
+        sign = np.asarray(sign)
+        ret = TTestAccumulator(self.is_welch[index], self.true_val[index], self.tracelen, self.offset, self.order)
+        ret.load_totals(self.totals())
+
+        pos = np.zeros(len(self.is_welch), dtype=int)
+        pos[self.welch] = np.arange(len(self.welch))
+        pos[self.student] = np.arange(len(self.student))
+
+        src = pos[index[ret.welch]]
+        flip = (sign[ret.welch] < 0)
+        ret.n1 = np.where(flip, self.n - self.n1[src], self.n1[src])
+        ret.S1 = np.where(flip[:, None], self.S - self.S1[src], self.S1[src])
+        ret.Q1 = np.where(flip[:, None], self.Q - self.Q1[src], self.Q1[src])
+        if self.order > 1:
+            ret.P1 = np.where(flip[:, None, None], self.P - self.P1[src], self.P1[src])
+
+        src = pos[index[ret.student]]
+        ret.S_x = self.S_x[src]
+        ret.S_xx = self.S_xx[src]
+        ret.S_xy = self.S_xy[src]
+        if self.order > 1:
+            ret.S_xP = self.S_xP[src]
+        return ret
+
+    def totals(self):
+        """Return the sums over all traces as a dictionary of arrays.
+        """
+        return dict((k, np.asarray(getattr(self, k))) for k in self.total_keys)
+
+    def load_totals(self, totals):
+        """Restore the sums over all traces saved by totals().
+        """
+        self.n = int(totals['n'])
+        self.S = np.array(totals['S'], dtype=np.float64)
+        self.Q = np.array(totals['Q'], dtype=np.float64)
+        if self.order > 1:
+            self.P = np.array(totals['P'], dtype=np.float64)
+
+    def test_state(self, i):
+        """Return the sums for test i as a dictionary of arrays.
+        """
+        if self.is_welch[i]:
+            j = np.searchsorted(self.welch, i)
+            keys = self.welch_keys
+        else:
+            j = np.searchsorted(self.student, i)
+            keys = self.student_keys
+        return dict((k, getattr(self, k)[j]) for k in keys)
+
+    def load_test_states(self, states):
+        """Restore the sums for every test from a list of test_state() outputs.
+        """
+        for i, state in enumerate(states):
+            if self.is_welch[i]:
+                j = np.searchsorted(self.welch, i)
+                keys = self.welch_keys
+            else:
+                j = np.searchsorted(self.student, i)
+                keys = self.student_keys
+            for k in keys:
+                getattr(self, k)[j] = state[k]
+
+    def ttest(self, order=1):
+        """Compute the t-statistics for all of the tests from the current sums.
+
+        Arguments:
+            order (int): order of the univariate t-test, from 1 up to the
+                accumulator's order. Tests of order 2 compare the variances
+                of the groups; higher orders compare standardized moments.
+
+        Returns:
+            (num_tests x tracelen array): t-statistic at each point in time
+        """
+        if order < 1 or order > self.order:
+            raise ValueError("Can't compute an order %d t-test from sums of order %d" % (order, self.order))
+        ret = np.zeros((len(self.is_welch), self.tracelen))
+        if order == 1:
+            if len(self.welch) > 0:
+                n1 = self.n1[:, None]
+                ret[self.welch] = welch_from_sums(
+                    n1, self.S1, self.Q1,
+                    self.n - n1, self.S - self.S1, self.Q - self.Q1)
+            if len(self.student) > 0:
+                ret[self.student] = student_from_sums(
+                    self.n, self.S_x[:, None], self.S_xx[:, None],
+                    self.S, self.Q, self.S_xy)
+            return ret
+
+        R = [self.n, self.S, self.Q] + list(self.P[:2*order - 2])
+        if len(self.welch) > 0:
+            n1 = self.n1[:, None]
+            R1 = [n1, self.S1, self.Q1] + [self.P1[:, k] for k in range(2*order - 2)]
+            R0 = [r - r1 for r, r1 in zip(R, R1)]
+            ret[self.welch] = welch_from_moments(
+                n1, moments_from_sums(R1, order),
+                self.n - n1, moments_from_sums(R0, order))
+        if len(self.student) > 0:
+            # Regress (y - mean)^order on x, expanding the power in terms of 
+            # the sums of x*y^k
+            mu = self.S / self.n
+            S_xyk = [self.S_x[:, None], self.S_xy] + [self.S_xP[:, k] for k in range(order - 1)]
+            S_xY = sum(comb(order, k) * (-mu)**(order - k) * S_xyk[k] for k in range(order + 1))
+            ret[self.student] = student_from_sums(
+                self.n, self.S_x[:, None], self.S_xx[:, None],
+                self.n * central_moment(R, order), self.n * central_moment(R, 2*order), S_xY)
+        return ret
+
+def chunk_ranges(start, stop, chunk_size):
+    """Split the traces [start, stop) into chunks of at most chunk_size.
+    """
+    for i in range(start, stop, chunk_size):
+        yield i, min(i + chunk_size, stop)
+
+def stream_ttest(acc, groups, traces, start, stop, chunk_size):
+    """Feed the traces [start, stop) through an accumulator one chunk at a time.
+
+    Only one chunk of traces is converted to floating point at once, so
+    traces can be a memmapped array much larger than RAM.
+
+    Arguments:
+        acc (TTestAccumulator): accumulator to update
+        groups (num_tests x numtraces array of int): groupings for all traces
+        traces (numtraces x tracelen array): traces to analyze
+        start, stop (int): range of traces to add
+        chunk_size (int): maximum number of traces per chunk
+    """
+    for i, j in chunk_ranges(start, stop, chunk_size):
+        acc.update(groups[:, i:j], traces[i:j])
+    return acc
+
+def batch_welch_ttest(group, traces):
+    """Compute Welch's t-statistic for many partitions of the same traces.
+
+    Each row of group selects the "true" traces. The per-group sums and sums
+    of squares for every row are found with two matrix products, so the trace
+    matrix is only scanned once for the whole batch.
+
+    Arguments:
+        group (num_tests x numtraces array of bool): partitions to test
+        traces (numtraces x tracelen array): traces to analyze
+
+    Returns:
+        (num_tests x tracelen array): t-statistic at each point in time
+    """
+    group = np.asarray(group, dtype=bool)
+    num_tests = len(group)
+    return batch_ttest(group, traces, np.ones(num_tests, dtype=bool), np.ones(num_tests, dtype=bool))
+
+def batch_student_ttest(group, traces):
+    """Compute the regression t-statistic for many groupings of the same traces.
+
+    Arguments:
+        group (num_tests x numtraces array of int): group values to regress on
+        traces (numtraces x tracelen array): traces to analyze
+
+    Returns:
+        (num_tests x tracelen array): t-statistic at each point in time
+    """
+    group = np.asarray(group)
+    num_tests = len(group)
+    return batch_ttest(group, traces, np.zeros(num_tests, dtype=bool), np.zeros(num_tests))
+
+def welch_from_sums(n1, S1, Q1, n0, S0, Q0):
+    """Welch's t-statistic from per-group counts, sums and sums of squares.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m1 = S1 / n1
+        m0 = S0 / n0
+        v1 = (Q1 - n1*m1**2) / (n1 - 1)
+        v0 = (Q0 - n0*m0**2) / (n0 - 1)
+        t = (m1 - m0) / np.sqrt(v1/n1 + v0/n0)
+    return np.nan_to_num(t)
+
+def student_from_sums(n, S_x, S_xx, S_y, S_yy, S_xy):
+    """Regression t-statistic from the sums of x, x^2, y, y^2 and x*y.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d_x = n*S_xx - S_x**2
+        beta = (n*S_xy - S_x*S_y) / d_x
+        s_e2 = (n*S_yy - S_y**2 - beta**2 * d_x) / n / (n-2)
+        s_beta2 = n*s_e2 / d_x
+        t = beta / np.sqrt(s_beta2)
+    return np.nan_to_num(t)
+
+def central_moment(R, k):
+    """k-th central moment from the power sums R[j] = sum(y^j), j = 0 ... k.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu = R[1] / R[0]
+        return sum(comb(k, j) * (R[j] / R[0]) * (-mu)**(k - j) for j in range(k + 1))
+
+def moments_from_sums(R, order):
+    """Mean and variance of the traces preprocessed for an order-d t-test.
+
+    For order 2, each trace is replaced by its squared distance from the mean;
+    for higher orders, by its standardized distance from the mean raised to
+    the power d. The mean and variance of the result only depend on the
+    central moments up to 2d, so they can be found from the power sums.
+
+    Arguments:
+        R (list of arrays): power sums R[j] = sum(y^j) for j = 0 ... 2*order
+        order (int): order of the t-test (2 or more)
+
+    Returns:
+        mean, var (arrays): mean and variance of the preprocessed traces
+    """
+    cm_d = central_moment(R, order)
+    cm_2d = central_moment(R, 2*order)
+    if order == 2:
+        return cm_d, cm_2d - cm_d**2
+    cm_2 = central_moment(R, 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return cm_d / cm_2**(order/2.0), (cm_2d - cm_d**2) / cm_2**order
+
+def welch_from_moments(n1, moments1, n0, moments0):
+    """Welch's t-statistic from per-group counts and (mean, variance) pairs.
+    """
+    [m1, v1] = moments1
+    [m0, v0] = moments0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (m1 - m0) / np.sqrt(v1/n1 + v0/n0)
+    return np.nan_to_num(t)
+
+def batch_ttest(groups, traces, is_welch, true_val, chunk_size=None, order=1):
+    """Run the t-test chosen by classify_groups() for every grouping.
+
+    Arguments:
+        groups (num_tests x numtraces array of int): one grouping per row
+        traces (numtraces x tracelen array): traces to analyze
+        is_welch, true_val: output of classify_groups() for the full groupings
+        chunk_size (int): maximum number of traces to load at once (default:
+            all of them)
+        order (int): order of the univariate t-test
+
+    Returns:
+        (num_tests x tracelen array): t-statistic at each point in time
+    """
+    groups = np.asarray(groups)
+    [numtraces, tracelen] = np.shape(traces)
+    if chunk_size is None:
+        chunk_size = max(numtraces, 1)
+    acc = TTestAccumulator(is_welch, true_val, tracelen, order=order)
+    stream_ttest(acc, groups, traces, 0, numtraces, chunk_size)
+    return acc.ttest(order)
+
+def combine_halves(t0, t1):
+    """Combine the t-tests on the two halves of the traces.
+
+    Points where the halves disagree on the sign are zeroed; elsewhere the
+    smaller magnitude is kept.
+    """
+    trace_comb = np.where(t0 * t1 < 0, 0, np.where(t0 > 0, np.minimum(t0, t1), np.maximum(t0, t1)))
+    return np.abs(trace_comb)
+
+# Test code starts here
+def test_batch_welch_ttest():
+    """Compare the batched Welch t-test against scipy on random data.
+    """
+    import scipy.stats
+    traces = np.random.randn(1000, 50)
+    group = np.random.randint(0, 2, (4, 1000)).astype(bool)
+
+    t_batch = batch_welch_ttest(group, traces)
+    for i in range(len(group)):
+        t_ref = scipy.stats.ttest_ind(traces[group[i]], traces[~group[i]], axis=0, equal_var=False).statistic
+        if not np.allclose(t_batch[i], t_ref):
+            raise ValueError("Batched Welch t-test differs from scipy in row %d" % i)
+
+    print "Batched Welch T-Test: [PASS]"
+
+def test_batch_student_ttest():
+    """Compare the batched Student t-test against scipy's linear regression.
+    """
+    import scipy.stats
+    traces = np.random.randn(1000, 20)
+    group = np.random.randint(0, 9, (3, 1000))
+
+    t_batch = batch_student_ttest(group, traces)
+    for i in range(len(group)):
+        for j in range(traces.shape[1]):
+            fit = scipy.stats.linregress(group[i], traces[:, j])
+            t_ref = fit.slope / fit.stderr
+            if not np.isclose(t_batch[i, j], t_ref):
+                raise ValueError("Batched Student t-test differs from scipy at (%d, %d)" % (i, j))
+
+    print "Batched Student T-Test: [PASS]"
+
+def test_stream_ttest():
+    """Make sure that streaming the traces in chunks gives the same t-tests.
+    """
+    traces = np.random.randn(1000, 20) + 100.0
+    groups = np.vstack([np.random.randint(0, 2, (2, 1000)), np.random.randint(0, 9, (2, 1000))])
+    [is_welch, true_val] = classify_groups(groups)
+
+    t_full = batch_ttest(groups, traces, is_welch, true_val)
+    t_chunk = batch_ttest(groups, traces, is_welch, true_val, chunk_size=97)
+    if not np.allclose(t_full, t_chunk):
+        raise ValueError("Streamed t-test differs from the single chunk version")
+
+    print "Streamed T-Test: [PASS]"
+
+def test_incremental_ttest():
+    """Make sure that saved sums can be extended with new traces.
+    """
+    traces = np.random.randn(1000, 20)
+    groups = np.vstack([np.random.randint(0, 2, (2, 1000)), np.random.randint(0, 9, (2, 1000))])
+    [is_welch, true_val] = classify_groups(groups)
+    offset = np.mean(traces, axis=0)
+
+    old = TTestAccumulator(is_welch, true_val, 20, offset)
+    old.update(groups[:, :600], traces[:600])
+    states = [old.test_state(i) for i in range(len(groups))]
+
+    new = TTestAccumulator(is_welch, true_val, 20, offset)
+    new.load_totals(old.totals())
+    new.load_test_states(states)
+    stream_ttest(new, groups, traces, 600, 1000, 128)
+
+    # Removing traces should undo them
+    extra = TTestAccumulator(is_welch, true_val, 20, offset)
+    extra.update(groups[:, 900:], traces[900:])
+    new.merge(extra, -1)
+
+    t_ref = batch_ttest(groups[:, :900], traces[:900], is_welch, true_val)
+    if not np.allclose(new.ttest(), t_ref):
+        raise ValueError("Incremental t-test differs from the full version")
+
+    print "Incremental T-Test: [PASS]"
+
+def test_higher_order_ttest():
+    """Compare the higher-order t-tests against preprocessing the traces.
+    """
+    import scipy.stats
+    traces = np.random.randn(2000, 10) + 3.0
+    groups = np.vstack([np.random.randint(0, 2, (2, 2000)), np.random.randint(0, 9, (2, 2000))])
+    [is_welch, true_val] = classify_groups(groups)
+
+    acc = TTestAccumulator(is_welch, true_val, 10, order=4)
+    stream_ttest(acc, groups, traces, 0, 2000, 300)
+    if not np.allclose(acc.ttest(1), batch_ttest(groups, traces, is_welch, true_val)):
+        raise ValueError("First-order t-test changed when sums of higher order were added")
+
+    for d in range(2, 5):
+        t = acc.ttest(d)
+        for i in range(len(groups)):
+            if is_welch[i]:
+                z = []
+                for sel in [groups[i] == true_val[i], groups[i] != true_val[i]]:
+                    y = traces[sel]
+                    y = y - np.mean(y, axis=0)
+                    if d > 2:
+                        y = y / np.std(y, axis=0)
+                    z.append(y**d)
+                t_ref = (np.mean(z[0], axis=0) - np.mean(z[1], axis=0)) / np.sqrt(
+                    np.var(z[0], axis=0)/len(z[0]) + np.var(z[1], axis=0)/len(z[1]))
+            else:
+                z = (traces - np.mean(traces, axis=0))**d
+                t_ref = np.array([scipy.stats.linregress(groups[i], z[:, j]) for j in range(10)])
+                t_ref = t_ref[:, 0] / t_ref[:, 4]
+            if not np.allclose(t[i], t_ref):
+                raise ValueError("Order %d t-test differs from the reference in row %d" % (d, i))
+
+    print "Higher-Order T-Test: [PASS]"
+
+def test_unique_groups():
+    """Make sure duplicated and complemented groupings share one t-test.
+    """
+    traces = np.random.randn(500, 10)
+    base = np.vstack([np.random.randint(0, 2, (2, 500)), np.random.randint(0, 9, (1, 500))])
+    groups = np.vstack([base, base[0], 1 - base[0], 5 * base[1] + 3, base[2]])
+    [is_welch, true_val] = classify_groups(groups)
+
+    [uniq, index, sign] = unique_groups(groups, is_welch, true_val)
+    if len(uniq) != 3:
+        raise ValueError("Expected 3 unique groupings; got %d" % len(uniq))
+
+    t_ref = batch_ttest(groups, traces, is_welch, true_val)
+    acc = TTestAccumulator(is_welch[uniq], true_val[uniq], 10)
+    acc.update(groups[uniq], traces)
+    if not np.allclose(sign[:, None] * acc.ttest()[index], t_ref):
+        raise ValueError("Fanned-out t-tests differ from the full version")
+    if not np.allclose(acc.expand(index, sign).ttest(), t_ref):
+        raise ValueError("Expanded t-tests differ from the full version")
+
+    acc = TTestAccumulator(is_welch[uniq], true_val[uniq], 10, order=3)
+    acc.update(groups[uniq], traces)
+    if not np.allclose(acc.expand(index, sign).ttest(3), batch_ttest(groups, traces, is_welch, true_val, order=3)):
+        raise ValueError("Expanded third-order t-tests differ from the full version")
+
+    print "Unique Groupings: [PASS]"
+
+def test_merge_ranges():
+    """Make sure merged ranges classify like the groupings of every trace.
+    """
+    groups = np.array([
+        [1, 1, 1, 1, 1, 1],  # constant
+        [1, 1, 1, 1, 2, 2],  # constant, then two-valued
+        [0, 1, 0, 1, 2, 0],  # two-valued, then a third value
+        [0, 1, 0, 1, 1, 0],  # two-valued all along
+        [3, 3, 3, 5, 5, 5],  # one value in each set
+        [0, 2, 1, 2, 2, 0],  # three values in the first set
+    ])
+    for split in range(1, 6):
+        # The sets can overlap, like the traces that move between halves
+        merged = merge_ranges(group_ranges(groups[:, :split]), group_ranges(groups[:, split-1:]))
+        [is_welch, true_val] = classify_ranges(merged)
+        [ref_welch, ref_val] = classify_groups(groups)
+        if not np.array_equal(is_welch, ref_welch) or not np.array_equal(true_val, ref_val):
+            raise ValueError("Merged ranges classify differently when split at %d" % split)
+
+    print "Merge Ranges: [PASS]"
+
+if __name__ == "__main__":
+    tests = [
+        test_merge_ranges,
+        test_batch_welch_ttest,
+        test_batch_student_ttest,
+        test_stream_ttest,
+        test_incremental_ttest,
+        test_unique_groups,
+        test_higher_order_ttest,
+    ]
+
+    for t in tests:
+        t()
@@ -0,0 +1,64 @@
+"""
+workers.py
+
+Long-lived pool of worker processes that runs the setup and analysis jobs of
+every project
+"""
+
+import multiprocessing as mp
+import traceback
+
+# The shared pool, and the number of processes in it
+pool = None
+num_workers = 0
+
+def init(processes=None):
+    """Start the worker service.
+
+    The workers are forked from the server once everything is imported, so
+    jobs don't pay for process startup or the ChipWhisperer imports. All jobs
+    go through the pool's single queue, so concurrent projects share the
+    processes instead of each starting their own.
+
+    Arguments:
+        processes (int): number of worker processes (default: one per core)
+    """
+    global pool, num_workers
+    if pool is not None:
+        return
+    num_workers = processes or mp.cpu_count()
+    pool = mp.Pool(num_workers)
+    print "Started %d worker processes" % num_workers
+
+def submit(func, args=(), callback=None):
+    """Queue a job to run func(*args) in the worker service.
+
+    The callback runs in the server process with the return value of func.
+    Any exception it raises is printed and dropped: the pool runs every 
+    callback on its result handler thread, which would die otherwise and 
+    leave every job of every project waiting forever.
+    """
+    if pool is None:
+        init()
+    if callback is not None:
+        callback = guard_callback(callback)
+    return pool.apply_async(func, args=args, callback=callback)
+
+def guard_callback(callback):
+    """Wrap a job callback so it can never raise.
+    """
+    def run(value):
+        try:
+            callback(value)
+        except:
+            print traceback.format_exc()
+    return run
+
+def close():
+    """Let the queued jobs finish, then stop the worker processes.
+    """
+    global pool
+    if pool is not None:
+        pool.close()
+        pool.join()
+        pool = None
@@ -0,0 +1,122 @@
+"""
+writer.py
+
+Background thread that saves the output of finished jobs to the database in
+batches
+"""
+
+import Queue
+import threading
+import time
+import traceback
+
+# Longest time (in seconds) a queued item waits before it's saved
+flush_interval = 1.0
+
+# The queue of (func, item) pairs, and the thread that empties it
+queue = None
+thread = None
+
+def init(interval=None):
+    """Start the writer thread.
+
+    Items queued with submit() are collected for up to flush_interval seconds
+    after the first one arrives, then handed over in one batch. This way a
+    burst of completions turns into one transaction, instead of one write per
+    item, and the callback threads never wait on the database.
+
+    Arguments:
+        interval (float): flush interval in seconds (default: flush_interval)
+    """
+    global queue, thread, flush_interval
+    if thread is not None:
+        return
+    if interval is not None:
+        flush_interval = interval
+    queue = Queue.Queue()
+    thread = threading.Thread(target=run, name='writer')
+    thread.daemon = True
+    thread.start()
+
+def submit(func, item):
+    """Queue item to be saved by func.
+
+    func is called in the writer thread with a list of every item queued for
+    it during the same flush, in the order they were queued.
+    """
+    if thread is None:
+        init()
+    queue.put((func, item))
+
+def flush(jobs):
+    """Hand each function its items from a list of (func, item) pairs.
+    """
+    batches = []
+    for [func, item] in jobs:
+        for b in batches:
+            if b[0] == func:
+                b[1].append(item)
+                break
+        else:
+            batches.append([func, [item]])
+    for [func, items] in batches:
+        try:
+            func(items)
+        except:
+            # Keep the thread alive for the next batch
+            print traceback.format_exc()
+
+def run():
+    stop = False
+    while not stop:
+        job = queue.get()
+        if job is None:
+            break
+        jobs = [job]
+        deadline = time.time() + flush_interval
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                job = queue.get(timeout=timeout)
+            except Queue.Empty:
+                break
+            if job is None:
+                stop = True
+                break
+            jobs.append(job)
+        flush(jobs)
+
+def close():
+    """Save everything that's queued, then stop the writer thread.
+    """
+    global queue, thread
+    if thread is not None:
+        queue.put(None)
+        thread.join()
+        queue = None
+        thread = None
+
+def test_writer():
+    batches = []
+    init(0.2)
+    try:
+        for i in range(5):
+            submit(batches.append, i)
+        time.sleep(0.5)
+        submit(batches.append, 5)
+    finally:
+        close()
+    if batches != [[0, 1, 2, 3, 4], [5]]:
+        raise ValueError("Items were batched wrong: %s" % batches)
+
+    print "Writer: [PASS]"
+
+if __name__ == "__main__":
+    tests = [
+        test_writer,
+    ]
+
+    for t in tests:
+        t()
@@ -2,6 +2,7 @@
 
 import datetime
 import getopt
+import io
 import matplotlib.pyplot as plt
 import numpy as np
 import os
@@ -68,15 +69,28 @@ def print_status(uri, block):
     if block:
         print "Analysis complete"
         
+def traces_to_detection(curve, t):
+    """Find the first trace count on a result's curve where max |t| > t.
+    
+    Returns None if the result has no curve or never goes over t.
+    """
+    if not curve:
+        return None
+    for n, t_max in zip(curve['numtraces'], curve['t_max']):
+        if t_max > t:
+            return n
+    return None
+    
 def gen_report(uri, ofname, t, ignore_list, plot_all_graphs=False):
     name_list = []
-    ttrace_list = []
     imax_list = []
     tmax_list = []
     graph_list = []
+    detect_list = []
        
     r = requests.get(uri, timeout=1)
     res_list = r.json()['project']['results']
+    samples = r.json()['project'].get('samples')
     
     cwp_uri = string.replace(uri, 'projects', 'cwprojects')
     metadata = requests.get(cwp_uri, timeout=1).json()['cwproject']
@@ -97,26 +111,31 @@ def gen_report(uri, ofname, t, ignore_list, plot_all_graphs=False):
             
         name = r.json()['result']['name']
 
-        try:
-            trace_comb = r.json()['result']['data']['trace_c']
-        except KeyError:            
+        summary = r.json()['result'].get('summary')
+        if summary is None:
             break
         
-        tabs = np.abs(trace_comb)
-        imax = np.argmax(tabs)
-        tmax = np.abs(tabs[imax])
+        imax = summary['i_max']
+        tmax = summary['t_max']
+        if samples:
+            # Report the sample in the original traces
+            imax = samples[imax]
         
         name_list.append(name)
-        ttrace_list.append(tabs)
         imax_list.append(imax)
         tmax_list.append(tmax)
+        detect_list.append(traces_to_detection(r.json()['result']['data'].get('curve'), t))
         
             
         if tmax > t or plot_all_graphs:
-            t_limit = [t] * len(ttrace_list[-1])
+            # Only download the t-trace when it's plotted
+            trace_uri = r.json()['result']['data']['trace_c_uri']
+            trace_comb = np.load(io.BytesIO(requests.get(trace_uri, timeout=5).content))
+            t_limit = [t] * len(trace_comb)
             
-            plt.plot(trace_comb)
-            plt.plot(t_limit)
+            x = samples if samples else range(len(trace_comb))
+            plt.plot(x, trace_comb)
+            plt.plot(x, t_limit)
             plt.grid()
             
             img_file = os.path.join(img_path, "%d.png" % i)
@@ -182,6 +201,9 @@ td a {
                         text('Test Name')
                     with tag('th'):
                         text('Max T-Test')
+                    if any(d is not None for d in detect_list):
+                        with tag('th'):
+                            text('Traces to Detection')
                     with tag('th'):
                         text('Result')             
                 for i in range(len(name_list)):
@@ -207,6 +229,10 @@ td a {
                         with tag('td'):
                             with tag('a', href='#%d'%(i+1)):
                                 text(str(tmax_list[i]))
+                        if any(d is not None for d in detect_list):
+                            with tag('td'):
+                                with tag('a', href='#%d'%(i+1)):
+                                    text(str(detect_list[i] or '-'))
                         with tag('td'):
                             with tag('a', href='#%d'%(i+1)):
                                 text("[FAIL]" if test_fail else "[PASS]")
@@ -219,6 +245,9 @@ td a {
                     text('Test %d: %s' % (i+1, name_list[i]))
                 text('Maximum t: %f @ %d %s' % (tmax_list[i], imax_list[i], pass_str))
                 stag('br')                
+                if detect_list[i]:
+                    text('Detected after %d traces' % detect_list[i])
+                    stag('br')
                 img_file = graph_list[i]
                 if img_file:
                     stag('img', src=img_file)
@@ -409,9 +438,14 @@ def cmd_run(argv):
     cwproject_file = None
     proj_title = None
     thread_count = 3
+    order = 1
+    curve = False
+    windows = None
+    decimate = 1
+    incremental = False
     
     try:
-        opts, args = getopt.getopt(argv, "bh", ["block", "config=", "cwproject=", "title=", "threads=", "help"])
+        opts, args = getopt.getopt(argv, "bh", ["block", "config=", "cwproject=", "title=", "threads=", "order=", "curve", "window=", "decimate=", "incremental", "help"])
     except getopt.GetoptError:
         usage(2)
     for opt, arg in opts:
@@ -421,6 +455,21 @@ def cmd_run(argv):
             proj_title = arg
         elif opt in ("--threads",):
             thread_count = int(arg)
+        elif opt in ("--order",):
+            order = int(arg)
+        elif opt in ("--curve",):
+            curve = True
+        elif opt in ("--window",):
+            try:
+                [lo, hi] = [int(x) for x in arg.split(':')]
+            except ValueError:
+                print "error: window %s should be start:stop" % arg
+                usage(2, 'run')
+            windows = (windows or []) + [[lo, hi]]
+        elif opt in ("--decimate",):
+            decimate = int(arg)
+        elif opt in ("--incremental",):
+            incremental = True
         elif opt in ("--config",):
             config_file = arg
         elif opt in ("--cwproject",):
@@ -467,6 +516,11 @@ def cmd_run(argv):
         'config':config_file,
         'num_threads':thread_count,
         'title':proj_title,
+        'order':order,
+        'curve':curve,
+        'windows':windows,
+        'decimate':decimate,
+        'incremental':incremental,
     }
     
     r = requests.post(server + '/projects', json=payload)
@@ -646,7 +700,13 @@ def usage(exit_code, cmd=None):
         print "  -b, --block    Block until the analysis is finished"
         print "  --cwproject c  Analyze the traces from the ChipWhisperer project file c"
         print "  --config c     Use the autoanalyzer configuration file c"
-        print "  --threads n    Use n threads for analysis (default: 4)"
+        print "  --threads n    Ignored; the server runs one worker per core"
+        print "  --order d      Also run univariate t-tests of orders 2 to d (default: 1)"
+        print "  --curve        Track max t against the number of traces"
+        print "  --window a:b   Only analyze samples a to b-1 (can be repeated)"
+        print "  --decimate n   Average every n samples into one point (default: 1)"
+        print "  --incremental  Save the t-test sums, so running the project again after"
+        print "                 adding traces only analyzes the new ones"
         print "  --title t      Title the project t (default: cwproject filename)"
         print "  -h, --help     Display this help"
         print ""